@@ -14,7 +14,7 @@ from . import moderation
 from .constants import (MODERATION_STATUS_REJECTED,
                         MODERATION_STATUS_APPROVED,
                         MODERATION_STATUS_PENDING)
-from .diff import get_changes_between_models
+from .diff import get_changes_between_models, get_diff_cache_key
 try:
     from .filterspecs import RegisteredContentTypeListFilter
 except ImportError:
@@ -31,16 +31,14 @@ from .utils import django_17, django_110
 
 
 def approve_objects(modeladmin, request, queryset):
-    for obj in queryset:
-        obj.approve(by=request.user)
+    queryset.approve(by=request.user)
 
 
 approve_objects.short_description = _("Approve selected moderated objects")
 
 
 def reject_objects(modeladmin, request, queryset):
-    for obj in queryset:
-        obj.reject(by=request.user)
+    queryset.reject(by=request.user)
 
 
 reject_objects.short_description = _("Reject selected moderated objects")
@@ -172,19 +170,23 @@ class ModeratedObjectAdmin(admin.ModelAdmin):
         changed_obj = moderated_object.changed_object
 
         moderator = moderation.get_moderator(changed_obj.__class__)
+        base_object = moderated_object.get_object_for_this_type()
 
         if moderator.visible_until_rejected:
             old_object = changed_obj
-            new_object = moderated_object.get_object_for_this_type()
+            new_object = base_object
         else:
-            old_object = moderated_object.get_object_for_this_type()
+            old_object = base_object
             new_object = changed_obj
 
         changes = list(get_changes_between_models(
             old_object,
             new_object,
             moderator.fields_exclude,
-            resolve_foreignkeys=moderator.resolve_foreignkeys).values())
+            resolve_foreignkeys=moderator.resolve_foreignkeys,
+            cache_key=get_diff_cache_key(
+                moderated_object, base_object, moderator.fields_exclude,
+                resolve_foreignkeys=moderator.resolve_foreignkeys)).values())
 
         if request.POST:
             admin_form = self.get_form(request, moderated_object)(request.POST)
@@ -5,9 +5,14 @@ class SimpleModerationConfig(AppConfig):
     name = "moderation"
     verbose_name = "Moderation"
 
+    def ready(self):
+        from .moderator import connect_user_group_signals
+        connect_user_group_signals()
+
 
 class ModerationConfig(SimpleModerationConfig):
     def ready(self):
+        super(ModerationConfig, self).ready()
         # We have to import this here because it imports from models.py
         from .helpers import auto_discover
         auto_discover()
@@ -0,0 +1,97 @@
+from __future__ import unicode_literals
+
+import json
+
+from django.apps import apps
+from django.utils import six
+
+
+class BaseCodec(object):
+    """
+    Converts a model instance to bytes and back for SerializedObjectField.
+    Codecs are selected through the ``serialize_format`` argument of the
+    field, under the name they were registered with.
+    """
+    # Prefix that identifies data written by this codec
+    magic = None
+
+    def can_decode(self, data):
+        return data.startswith(self.magic)
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class CompactCodec(BaseCodec):
+    """
+    Stores a schema version, the model label and the concrete fields of the
+    instance as parallel attname and value lists, encoded as compact JSON
+    behind a binary header. Parents of multi-table inherited models need no
+    separate entries, as their fields are concrete fields of the child.
+    """
+    magic = b'\x00mc'
+    version = 1
+
+    native_types = (bool, float) + six.integer_types + six.string_types
+
+    def encode(self, obj):
+        opts = obj._meta
+        names = []
+        values = []
+        for field in opts.concrete_fields:
+            value = field.value_from_object(obj)
+            if not (value is None or isinstance(value, self.native_types)):
+                value = field.value_to_string(obj)
+            names.append(field.attname)
+            values.append(value)
+
+        payload = [self.version,
+                   '%s.%s' % (opts.app_label, opts.model_name),
+                   names,
+                   values]
+        return self.magic + json.dumps(payload,
+                                       separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        payload = json.loads(data[len(self.magic):].decode('utf-8'))
+        version, label, names, values = payload
+        if version != self.version:
+            raise ValueError("Unsupported %s schema version: %s" %
+                             (self.__class__.__name__, version))
+
+        model_class = apps.get_model(label)
+        data = dict(zip(names, values))
+        args = []
+        for field in model_class._meta.concrete_fields:
+            try:
+                value = field.to_python(data[field.attname])
+            except KeyError:
+                # Field added to the model since this was written
+                value = field.get_default()
+            args.append(value)
+
+        return model_class(*args)
+
+
+CODECS = {
+    'compact': CompactCodec,
+}
+
+
+def register_codec(name, codec_class):
+    """Makes codec_class available as serialize_format=name"""
+    if not issubclass(codec_class, BaseCodec):
+        raise TypeError("The codec '%s' needs to inherit from the "
+                        "BaseCodec class" % codec_class)
+    CODECS[name] = codec_class
+
+
+def get_codec(name):
+    """Returns a codec instance for name, or None for Django serializers"""
+    codec_class = CODECS.get(name)
+    if codec_class is None:
+        return None
+    return codec_class()
@@ -11,3 +11,34 @@ if MODERATORS:
         "`%s` is deprecated, use `%s` instead." %
         ("DJANGO_MODERATION_MODERATORS", "MODERATION_MODERATORS"))
 MODERATORS = getattr(settings, "MODERATION_MODERATORS", ())
+
+# Cache in which the ids of the groups named by auto_approve_for_groups and
+# auto_reject_for_groups are kept, or None to look them up every time
+GROUP_CACHE = getattr(settings, "MODERATION_GROUP_CACHE", "default")
+GROUP_CACHE_TIMEOUT = getattr(settings, "MODERATION_GROUP_CACHE_TIMEOUT", 60)
+
+# Threads and messages waiting for them used by the threaded message
+# backends
+THREADED_MAX_WORKERS = getattr(settings, "MODERATION_THREADED_MAX_WORKERS", 2)
+THREADED_MAX_QUEUED = getattr(settings, "MODERATION_THREADED_MAX_QUEUED", 100)
+
+# Seconds after which the pooled message backends reopen an unused
+# connection to the mail server
+POOLED_IDLE_TIMEOUT = getattr(settings, "MODERATION_POOLED_IDLE_TIMEOUT", 60)
+
+# Changes between longer texts, or needing more word insertions and
+# deletions, are diffed line by line instead of word by word
+DIFF_MAX_TOKENS = getattr(settings, "MODERATION_DIFF_MAX_TOKENS", 10000)
+DIFF_MAX_EDITS = getattr(settings, "MODERATION_DIFF_MAX_EDITS", 1000)
+
+# Cache in which the admin keeps rendered diffs, or None to not cache them.
+# Diffs longer than DIFF_CACHE_MAX_SIZE characters aren't cached.
+DIFF_CACHE = getattr(settings, "MODERATION_DIFF_CACHE", "default")
+DIFF_CACHE_TIMEOUT = getattr(settings, "MODERATION_DIFF_CACHE_TIMEOUT",
+                             60 * 60 * 24)
+DIFF_CACHE_MAX_SIZE = getattr(settings, "MODERATION_DIFF_CACHE_MAX_SIZE",
+                              100000)
+
+# Template with which text diffs are rendered, given the diff_operations,
+# instead of building their HTML in Python
+DIFF_TEMPLATE = getattr(settings, "MODERATION_DIFF_TEMPLATE", None)
@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-import difflib
+import bisect
+import hashlib
 import re
 import sys
+from collections import Counter, namedtuple
 
+from django.core.cache import caches
 from django.db.models import fields
+from django.utils.encoding import force_bytes
+from django.utils.safestring import mark_safe
 try:
     from django.db.models.fields.related import ForeignObject
 except ImportError:
     from django.db.models.fields.related import RelatedField as ForeignObject
-from django.utils.html import escape
 
 
 class BaseChange(object):
@@ -18,10 +22,40 @@ class BaseChange(object):
         value1, value2 = self.change
         return 'Change object: %s - %s' % (value1, value2)
 
-    def __init__(self, verbose_name, field, change):
+    def __init__(self, verbose_name, field, change, cache_key=None):
         self.verbose_name = verbose_name
         self.field = field
         self.change = change
+        self.cache_key = cache_key
+
+    @property
+    def diff(self):
+        """
+        The diff rendered by get_diff(), kept in the MODERATION_DIFF_CACHE
+        cache if the change has a cache_key
+        """
+        from .conf.settings import (DIFF_CACHE, DIFF_CACHE_TIMEOUT,
+                                    DIFF_CACHE_MAX_SIZE)
+
+        if self.cache_key is None or DIFF_CACHE is None or \
+                not self.changed:
+            return self.get_diff()
+
+        cache = caches[DIFF_CACHE]
+        diff = cache.get(self.cache_key)
+        if diff is None:
+            diff = self.get_diff()
+            if len(diff) <= DIFF_CACHE_MAX_SIZE:
+                cache.set(self.cache_key, diff, DIFF_CACHE_TIMEOUT)
+        return diff
+
+    @property
+    def changed(self):
+        value1, value2 = self.change
+        return value1 != value2
+
+    def get_diff(self):
+        raise NotImplementedError
 
     def render_diff(self, template, context):
         from django.template.loader import render_to_string
@@ -31,80 +65,188 @@ class BaseChange(object):
 
 class TextChange(BaseChange):
 
-    @property
-    def diff(self):
-        value1, value2 = escape(self.change[0]), escape(self.change[1])
-        if value1 == value2:
-            return value1
+    def get_diff(self):
+        from .conf.settings import DIFF_TEMPLATE
 
-        return self.render_diff(
-            'moderation/html_diff.html',
-            {'diff_operations': get_diff_operations(*self.change)})
+        if not self.changed:
+            return mark_safe(_escape(self.change[0]))
+
+        diff_operations = get_diff_operations(*self.change)
+        if DIFF_TEMPLATE:
+            return self.render_diff(DIFF_TEMPLATE,
+                                    {'diff_operations': diff_operations})
+        return mark_safe(render_diff_operations(diff_operations))
 
 
 class ImageChange(BaseChange):
 
-    @property
-    def diff(self):
+    def get_diff(self):
         left_image, right_image = self.change
         return self.render_diff(
             'moderation/image_diff.html',
             {'left_image': left_image, 'right_image': right_image})
 
 
-def get_change(model1, model2, field, resolve_foreignkeys=False):
+# How get_changes_between_models compares a field, worked out once per model
+FieldPlan = namedtuple('FieldPlan',
+                       'name key field display_method is_foreign_object '
+                       'is_image')
+
+# Model class -> its FieldPlans
+_comparison_plans = {}
+
+
+def get_comparison_plan(model_class):
+    """
+    Returns the FieldPlans of the fields of model_class that are compared
+    for changes
+    """
     try:
-        value1 = getattr(model1, "get_%s_display" % field.name)()
-        value2 = getattr(model2, "get_%s_display" % field.name)()
-    except AttributeError:
-        if isinstance(field, ForeignObject) and resolve_foreignkeys:
-            value1 = str(getattr(model1, field.name))
-            value2 = str(getattr(model2, field.name))
-        else:
-            value1 = field.value_from_object(model1)
-            value2 = field.value_from_object(model2)
+        return _comparison_plans[model_class]
+    except KeyError:
+        plan = _comparison_plans[model_class] = tuple(
+            _get_field_plan(model_class, field)
+            for field in model_class._meta.fields
+            if not isinstance(field, fields.AutoField))
+        return plan
+
+
+def _get_field_plan(model_class, field):
+    display_method = 'get_%s_display' % field.name
+    if not hasattr(model_class, display_method):
+        display_method = None
+
+    return FieldPlan(
+        name=field.name,
+        key='{}__{}'.format(model_class.__name__.lower(), field.name),
+        field=field,
+        display_method=display_method,
+        is_foreign_object=isinstance(field, ForeignObject),
+        is_image=isinstance(field, fields.files.ImageField))
+
+
+def _get_values(field_plan, model1, model2, resolve_foreignkeys):
+    if field_plan.display_method is not None:
+        return (getattr(model1, field_plan.display_method)(),
+                getattr(model2, field_plan.display_method)())
+    if field_plan.is_foreign_object and resolve_foreignkeys:
+        return (str(getattr(model1, field_plan.name)),
+                str(getattr(model2, field_plan.name)))
+    return (field_plan.field.value_from_object(model1),
+            field_plan.field.value_from_object(model2))
+
+
+def _get_planned_fields(model_class, excludes, includes):
+    excludes = set(excludes or ())
+    includes = set(includes or ())
+
+    for field_plan in get_comparison_plan(model_class):
+        if includes and field_plan.name not in includes:
+            continue
+        if field_plan.name in excludes:
+            continue
+        yield field_plan
+
 
-    change = get_change_for_type(
+def get_change(model1, model2, field, resolve_foreignkeys=False):
+    return get_change_for_type(
         field.verbose_name,
-        (value1, value2),
+        _get_values(_get_field_plan(model1.__class__, field), model1, model2,
+                    resolve_foreignkeys),
         field,
     )
 
-    return change
-
 
 def get_changes_between_models(model1, model2, excludes=None, includes=None,
-                               resolve_foreignkeys=False):
+                               resolve_foreignkeys=False, cache_key=None):
+    """
+    Returns the changes of each field between the two model instances. Their
+    diffs are cached under cache_key and the field name, if it is given,
+    except those showing related objects, whose text cache_key doesn't
+    cover.
+    """
     changes = {}
 
-    if excludes is None:
-        excludes = []
+    for field_plan in _get_planned_fields(model1.__class__, excludes,
+                                          includes):
+        change = get_change_for_type(
+            field_plan.field.verbose_name,
+            _get_values(field_plan, model1, model2, resolve_foreignkeys),
+            field_plan.field)
+        if cache_key is not None and not (field_plan.is_foreign_object and
+                                          resolve_foreignkeys):
+            change.cache_key = '%s:%s' % (cache_key, field_plan.key)
+        changes[field_plan.key] = change
 
-    if includes is None:
-        includes = []
+    return changes
 
-    for field in model1._meta.fields:
-        if includes and field.name not in includes:
-            continue
 
-        if not (isinstance(field, (fields.AutoField,))):
-            if field.name in excludes:
-                continue
+def iter_changed_fields(model1, model2, excludes=None, includes=None):
+    """
+    Yields the names of the fields whose values differ between the two model
+    instances, as get_changes_between_models() would report them, without
+    building the changes.
+    """
+    for field_plan in _get_planned_fields(model1.__class__, excludes,
+                                          includes):
+        value1, value2 = _get_values(field_plan, model1, model2, False)
+        if not field_plan.is_image:
+            value1, value2 = _to_text(value1), _to_text(value2)
+        if value1 != value2:
+            yield field_plan.name
+
+
+# Part of every diff cache key, raise it when the HTML of the diffs changes
+DIFF_CACHE_VERSION = 1
+
+
+def get_diff_cache_key(moderated_object, base_object=None, excludes=None,
+                       includes=None, resolve_foreignkeys=False):
+    """
+    Returns the key of the diffs of the moderated object, which changes
+    whenever the moderated object is saved, or the values of base_object,
+    the live object its changes are compared with, change. The fields and
+    settings the diffs are built with are part of the key too.
+    """
+    from .conf.settings import DIFF_TEMPLATE, DIFF_MAX_TOKENS, DIFF_MAX_EDITS
+
+    options = (sorted(excludes or ()), sorted(includes or ()),
+               bool(resolve_foreignkeys), DIFF_TEMPLATE, DIFF_MAX_TOKENS,
+               DIFF_MAX_EDITS)
+    key = 'moderation-diff:%s:%s:%s:%s' % (
+        DIFF_CACHE_VERSION,
+        hashlib.md5(force_bytes(repr(options))).hexdigest(),
+        moderated_object.pk,
+        moderated_object.updated.strftime('%Y%m%d%H%M%S%f'))
+    if base_object is not None:
+        version = hashlib.md5()
+        for field_plan in get_comparison_plan(base_object.__class__):
+            value = field_plan.field.value_from_object(base_object)
+            version.update(force_bytes(value) + b'\0')
+        key = '%s:%s' % (key, version.hexdigest())
+    return key
 
-            name = "{}__{}".format(model1.__class__.__name__.lower(), field.name)
 
-            changes[name] = get_change(model1, model2, field,
-                                       resolve_foreignkeys)
+def get_diff_operations(a, b):
+    """
+    Returns the operations turning a into b word by word, or line by line
+    when that is too costly. Each operation is a dict with 'operation' being
+    one of 'equal', 'replace', 'delete' or 'insert', and the 'deleted' and
+    'inserted' text.
+    """
+    from .conf.settings import DIFF_MAX_TOKENS, DIFF_MAX_EDITS
 
-    return changes
+    a_words = re.split('(\W+)', a)
+    b_words = re.split('(\W+)', b)
+    opcodes = get_opcodes(a_words, b_words, DIFF_MAX_TOKENS, DIFF_MAX_EDITS)
 
+    if opcodes is None:
+        a_words = a.splitlines(True)
+        b_words = b.splitlines(True)
+        opcodes = get_line_opcodes(a_words, b_words, DIFF_MAX_EDITS)
 
-def get_diff_operations(a, b):
     operations = []
-    a_words = re.split('(\W+)', a)
-    b_words = re.split('(\W+)', b)
-    sequence_matcher = difflib.SequenceMatcher(None, a_words, b_words)
-    for opcode in sequence_matcher.get_opcodes():
+    for opcode in opcodes:
         operation, start_a, end_a, start_b, end_b = opcode
 
         deleted = ''.join(a_words[start_a:end_a])
@@ -116,6 +258,252 @@ def get_diff_operations(a, b):
     return operations
 
 
+def get_opcodes(a, b, max_tokens, max_edits):
+    """
+    Returns the opcodes of a shortest edit script between the sequences a and
+    b, in the format of difflib.SequenceMatcher.get_opcodes(), or None when
+    more than max_tokens items differ after their common beginning and end,
+    or more than max_edits insertions and deletions are needed.
+    """
+    # Compare ids rather than the items themselves
+    ids = {}
+    a = [ids.setdefault(item, len(ids)) for item in a]
+    b = [ids.setdefault(item, len(ids)) for item in b]
+    n, m = len(a), len(b)
+
+    prefix = 0
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < n - prefix and suffix < m - prefix and
+           a[n - suffix - 1] == b[m - suffix - 1]):
+        suffix += 1
+
+    a_middle = a[prefix:n - suffix]
+    b_middle = b[prefix:m - suffix]
+    if len(a_middle) + len(b_middle) > max_tokens:
+        return None
+
+    middle = _myers_opcodes(a_middle, b_middle, max_edits)
+    if middle is None:
+        return None
+
+    opcodes = []
+    if prefix:
+        opcodes.append(('equal', 0, prefix, 0, prefix))
+    for tag, i1, i2, j1, j2 in middle:
+        opcodes.append((tag, i1 + prefix, i2 + prefix, j1 + prefix,
+                        j2 + prefix))
+    if suffix:
+        opcodes.append(('equal', n - suffix, n, m - suffix, m))
+    return opcodes
+
+
+def get_line_opcodes(a, b, max_edits):
+    """
+    Returns the opcodes turning the lines a into b, in the format of
+    get_opcodes(), at a cost close to linear however much changed. Lines
+    found once in both texts are matched in order first, and only the gaps
+    between them are diffed, or replaced as a whole when that needs more than
+    max_edits insertions and deletions.
+    """
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a]
+    b = [ids.setdefault(line, len(ids)) for line in b]
+    n, m = len(a), len(b)
+
+    a_counts = Counter(a)
+    b_counts = Counter(b)
+    b_positions = dict((item, j) for j, item in enumerate(b)
+                       if b_counts[item] == 1)
+    unique = [(i, b_positions[item]) for i, item in enumerate(a)
+              if a_counts[item] == 1 and item in b_positions]
+
+    opcodes = []
+    i = j = 0
+    for anchor_i, anchor_j in _increasing_pairs(unique) + [(n, m)]:
+        gap = _gap_opcodes(a, b, i, anchor_i, j, anchor_j, max_edits)
+        if anchor_i < n:
+            gap.append(('equal', anchor_i, anchor_i + 1,
+                        anchor_j, anchor_j + 1))
+        for opcode in gap:
+            if opcode[0] == 'equal' and opcodes and \
+                    opcodes[-1][0] == 'equal':
+                # Join runs of unchanged lines
+                opcodes[-1] = ('equal', opcodes[-1][1], opcode[2],
+                               opcodes[-1][3], opcode[4])
+            else:
+                opcodes.append(opcode)
+        i, j = anchor_i + 1, anchor_j + 1
+    return opcodes
+
+
+def _increasing_pairs(pairs):
+    """
+    Returns the longest run of the (i, j) pairs, sorted by i, in which j
+    increases too, by patience sorting
+    """
+    # tails[length - 1] is the index in pairs ending the best run of length
+    tails = []
+    tail_js = []
+    previous = [None] * len(pairs)
+    for index, (i, j) in enumerate(pairs):
+        length = bisect.bisect_left(tail_js, j)
+        if length:
+            previous[index] = tails[length - 1]
+        if length == len(tails):
+            tails.append(index)
+            tail_js.append(j)
+        else:
+            tails[length] = index
+            tail_js[length] = j
+
+    run = []
+    index = tails[-1] if tails else None
+    while index is not None:
+        run.append(pairs[index])
+        index = previous[index]
+    run.reverse()
+    return run
+
+
+def _gap_opcodes(a, b, start_a, end_a, start_b, end_b, max_edits):
+    if start_a == end_a and start_b == end_b:
+        return []
+
+    middle = _myers_opcodes(a[start_a:end_a], b[start_b:end_b], max_edits)
+    if middle is None:
+        if start_a == end_a:
+            tag = 'insert'
+        elif start_b == end_b:
+            tag = 'delete'
+        else:
+            tag = 'replace'
+        return [(tag, start_a, end_a, start_b, end_b)]
+
+    return [(tag, i1 + start_a, i2 + start_a, j1 + start_b, j2 + start_b)
+            for tag, i1, i2, j1, j2 in middle]
+
+
+def _myers_opcodes(a, b, max_edits):
+    """
+    Myers' O((N+M)D) diff of the sequences a and b, giving up after
+    max_edits insertions and deletions.
+    """
+    n, m = len(a), len(b)
+    maximum = min(n + m, max_edits)
+    offset = maximum + 1
+    # Furthest x reached on each diagonal k = x - y, at index k + offset
+    v = [0] * (2 * offset + 1)
+    # v[-d - 1:d + 2] before each round d, to find the path back
+    trace = []
+
+    for d in range(maximum + 1):
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and
+                           v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+
+            if x >= n and y >= m:
+                return _trace_to_opcodes(trace, n, m)
+    return None
+
+
+def _trace_to_opcodes(trace, n, m):
+    # Walk back from the end, collecting the moves made
+    moves = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        # v[0] is for the diagonal -d - 1
+        if k == -d or (k != d and v[k + d] < v[k + d + 2]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k + d + 1]
+        prev_y = prev_x - prev_k
+
+        while x > prev_x and y > prev_y:
+            moves.append('equal')
+            x -= 1
+            y -= 1
+        if d > 0:
+            moves.append('insert' if x == prev_x else 'delete')
+        x, y = prev_x, prev_y
+    moves.reverse()
+
+    opcodes = []
+    i = j = 0
+    start = 0
+    while start < len(moves):
+        end = start
+        if moves[start] == 'equal':
+            while end < len(moves) and moves[end] == 'equal':
+                end += 1
+            opcodes.append(('equal', i, i + end - start,
+                            j, j + end - start))
+            i += end - start
+            j += end - start
+        else:
+            while end < len(moves) and moves[end] != 'equal':
+                end += 1
+            deleted = moves[start:end].count('delete')
+            inserted = end - start - deleted
+            if deleted and inserted:
+                tag = 'replace'
+            elif deleted:
+                tag = 'delete'
+            else:
+                tag = 'insert'
+            opcodes.append((tag, i, i + deleted, j, j + inserted))
+            i += deleted
+            j += inserted
+        start = end
+    return opcodes
+
+
+def _escape(text):
+    # django.utils.html.escape() without the lazy string and SafeText
+    # handling, which cost more than the escaping itself
+    return text.replace('&', '&amp;').replace('<', '&lt;')\
+               .replace('>', '&gt;').replace('"', '&quot;')\
+               .replace("'", '&#39;')
+
+
+def render_diff_operations(diff_operations):
+    """
+    Returns the HTML of the diff operations, like the
+    moderation/html_diff.html template renders them
+    """
+    html = []
+    for operation in diff_operations:
+        kind = operation['operation']
+        if kind == 'replace':
+            html.append('<del class="diff modified">%s</del>'
+                        '<ins class="diff modified">%s</ins>' %
+                        (_escape(operation['deleted']),
+                         _escape(operation['inserted'])))
+        elif kind == 'delete':
+            html.append('<del class="diff">%s</del>' %
+                        _escape(operation['deleted']))
+        elif kind == 'insert':
+            html.append('<ins class="diff">%s</ins>' %
+                        _escape(operation['inserted']))
+        elif kind == 'equal':
+            html.append('<span>%s</span>' % _escape(operation['inserted']))
+    html.append('\n')
+    return ''.join(html)
+
+
 def html_to_list(html):
     pattern = re.compile(r'&.*?;|(?:<[^<]*?>)|'
                          '(?:\w[\w-]*[ ]*)|(?:<[^<]*?>)|'
@@ -125,6 +513,13 @@ def html_to_list(html):
             [_f for _f in pattern.findall(html) if _f]]
 
 
+def _to_text(value):
+    if sys.version < '3':
+        if value and (type(value) is str or type(value) is unicode):  # NOQA
+            value = value.encode('utf-8')
+    return str(value)
+
+
 def get_change_for_type(verbose_name, change, field):
     if isinstance(field, fields.files.ImageField):
         change = ImageChange(
@@ -134,16 +529,11 @@ def get_change_for_type(verbose_name, change, field):
             change)
     else:
         value1, value2 = change
-        if sys.version < '3':
-            if value1 and (type(value1) is str or type(value1) is unicode):  # NOQA
-                value1 = value1.encode('utf-8')
-            if value2 and (type(value2) is str or type(value2) is unicode):  # NOQA
-                value2 = value2.encode('utf-8')
 
         change = TextChange(
             verbose_name,
             field,
-            (str(value1), str(value2)),
+            (_to_text(value1), _to_text(value2)),
         )
 
     return change
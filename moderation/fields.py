@@ -4,6 +4,54 @@ from django.conf import settings
 from django.core import serializers
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
+from django.utils import six
+
+from . import serialization
+from .codecs import get_codec
+from .utils import django_18
+
+
+# Types of the value held before deserialization: text for Django
+# serializer formats, bytes (or memoryview on some backends) for codecs
+RAW_TYPES = six.string_types + (six.binary_type, memoryview)
+
+
+class SerializedObjectDescriptor(object):
+    '''Descriptor used by SerializedObjectField in lazy mode.
+
+       Keeps the serialized text loaded from the database and only
+       deserializes it on first access, caching the resulting instance.
+    '''
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+
+        attname = self.field.attname
+        try:
+            value = instance.__dict__[attname]
+        except KeyError:
+            # Deferred field, load it the same way Django would
+            if django_18():
+                instance.refresh_from_db(fields=[attname])
+            else:
+                manager = instance.__class__._default_manager
+                instance.__dict__[attname] = manager.using(
+                    instance._state.db).filter(pk=instance.pk).values_list(
+                    attname, flat=True).get()
+            value = instance.__dict__[attname]
+
+        if isinstance(value, RAW_TYPES):
+            value = self.field._deserialize(value) if value else None
+            instance.__dict__[attname] = value
+
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
 
 
 class SerializedObjectField(models.TextField):
@@ -29,13 +77,34 @@ class SerializedObjectField(models.TextField):
        >>> a.object.__dict__
        {'field': 'test', 'id': 1}
 
+       With lazy=True the stored text is only deserialized when the
+       attribute is first read, instead of on every instantiation.
+
+       serialize_format may also name a codec from moderation.codecs, such
+       as 'compact', in which case values are stored in a binary column.
+       Rows written in Django's json format remain readable.
+
     '''
 
-    def __init__(self, serialize_format='json', *args, **kwargs):
+    def __init__(self, serialize_format='json', lazy=False, *args, **kwargs):
         self.serialize_format = serialize_format
+        self.codec = get_codec(serialize_format)
+        self.lazy = lazy
         super(SerializedObjectField, self).__init__(*args, **kwargs)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(SerializedObjectField,
+                                         self).deconstruct()
+        if self.serialize_format != 'json':
+            kwargs['serialize_format'] = self.serialize_format
+        if self.lazy:
+            kwargs['lazy'] = True
+        return name, path, args, kwargs
+
     def _serialize(self, value):
+        if self.codec is not None:
+            return self.codec.encode(value) if value else b''
+
         if not value:
             return ''
 
@@ -45,11 +114,34 @@ class SerializedObjectField(models.TextField):
                           for f in list(value._meta.parents.values())
                           if f is not None]
 
+        if self.serialize_format == 'json':
+            try:
+                return serialization.dumps(value_set)
+            except serialization.Unsupported:
+                pass
+
         return serializers.serialize(self.serialize_format, value_set)
 
     def _deserialize(self, value):
+        serialize_format = self.serialize_format
+        if self.codec is not None:
+            if isinstance(value, memoryview):
+                value = value.tobytes()
+            if isinstance(value, six.binary_type):
+                if self.codec.can_decode(value):
+                    return self.codec.decode(value)
+                value = value.decode(settings.DEFAULT_CHARSET)
+            # Written in json before the field switched to a codec
+            serialize_format = 'json'
+
+        if serialize_format == 'json':
+            try:
+                return serialization.loads(value)
+            except serialization.Unsupported:
+                pass
+
         obj_generator = serializers.deserialize(
-            self.serialize_format,
+            serialize_format,
             value.encode(settings.DEFAULT_CHARSET),
             ignorenonexistent=True)
 
@@ -68,23 +160,50 @@ class SerializedObjectField(models.TextField):
         return obj
 
     def db_type(self, connection=None):
+        if self.codec is not None:
+            return models.BinaryField().db_type(connection)
         return 'text'
 
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if self.codec is None:
+            return super(SerializedObjectField, self).get_db_prep_value(
+                value, connection, prepared)
+        if isinstance(value, six.text_type):
+            # Legacy json row saved again without being read
+            value = value.encode(settings.DEFAULT_CHARSET)
+        if value is not None:
+            return connection.Database.Binary(value)
+        return value
+
     def pre_save(self, model_instance, add):
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, RAW_TYPES):
+            # Never deserialized, write back the text as it was loaded
+            return value
+
         value = getattr(model_instance, self.attname, None)
         return self._serialize(value)
 
     def contribute_to_class(self, cls, name):
         self.class_name = cls
         super(SerializedObjectField, self).contribute_to_class(cls, name)
-        models.signals.post_init.connect(self.post_init)
+        if self.lazy:
+            setattr(cls, self.attname, SerializedObjectDescriptor(self))
+        else:
+            # Only listen to this model and its subclasses, so instantiating
+            # any other model does not dispatch to post_init
+            models.signals.post_init.connect(self.post_init, sender=cls)
+            models.signals.class_prepared.connect(self.connect_subclass)
+
+    def connect_subclass(self, sender, **kwargs):
+        # Proxies and multi-table children inherit the field without
+        # contribute_to_class() being called for them
+        if not sender._meta.abstract and issubclass(sender, self.class_name):
+            models.signals.post_init.connect(self.post_init, sender=sender)
 
     def post_init(self, **kwargs):
         if 'sender' in kwargs and 'instance' in kwargs:
-            sender = kwargs['sender']
-            if (sender == self.class_name or sender._meta.proxy and
-                issubclass(sender, self.class_name)) and\
-               hasattr(kwargs['instance'], self.attname):
+            if hasattr(kwargs['instance'], self.attname):
                 value = self.value_from_object(kwargs['instance'])
 
                 if value:
@@ -0,0 +1,31 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ... import moderation
+from ...utils import django_18
+
+
+class Command(BaseCommand):
+    help = ("Sends the digests of moderators with moderator_digest enabled "
+            "that are due")
+
+    if not django_18():
+        option_list = BaseCommand.option_list + (
+            make_option(
+                '--all', action='store_true', default=False, dest='all',
+                help='Send the digests whether they are due or not'),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true', default=False,
+            help='Send the digests whether they are due or not')
+
+    def handle(self, *args, **options):
+        for moderator in moderation.get_moderators():
+            if moderator.moderator_digest and \
+                    (options['all'] or moderator.digest_is_due()):
+                moderator.send_digest()
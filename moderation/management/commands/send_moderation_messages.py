@@ -0,0 +1,79 @@
+from __future__ import unicode_literals
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...message_backends import send_queued_messages
+from ...utils import django_18
+
+
+class Command(BaseCommand):
+    help = ("Sends the notifications stored by the queued moderation "
+            "message backends")
+
+    if not django_18():
+        option_list = BaseCommand.option_list + (
+            make_option(
+                '--batch-size', type='int', default=100, dest='batch_size',
+                help='Number of messages sent over one connection'),
+            make_option(
+                '--max-attempts', type='int', default=3, dest='max_attempts',
+                help='Number of times a message is tried before giving up'),
+            make_option(
+                '--retry-delay', type='float', default=60,
+                dest='retry_delay',
+                help='Seconds after which a failed message is tried again, '
+                     'doubled with every failed attempt'),
+            make_option(
+                '--loop', action='store_true', default=False, dest='loop',
+                help='Keep waiting for new messages instead of exiting '
+                     'once the queue is empty'),
+            make_option(
+                '--sleep', type='float', default=5, dest='sleep',
+                help='Seconds to wait for new messages with --loop'),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of messages sent over one connection')
+        parser.add_argument(
+            '--max-attempts', type=int, default=3,
+            help='Number of times a message is tried before giving up')
+        parser.add_argument(
+            '--retry-delay', type=float, default=60,
+            help='Seconds after which a failed message is tried again, '
+                 'doubled with every failed attempt')
+        parser.add_argument(
+            '--loop', action='store_true', default=False,
+            help='Keep waiting for new messages instead of exiting once '
+                 'the queue is empty')
+        parser.add_argument(
+            '--sleep', type=float, default=5,
+            help='Seconds to wait for new messages with --loop')
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = send_queued_messages(
+                batch_size=options['batch_size'],
+                max_attempts=options['max_attempts'],
+                retry_delay=options['retry_delay'])
+            total_sent += sent
+            total_failed += failed
+
+            if sent:
+                # Messages that failed are retried once their retry delay
+                # passed, until they run out of attempts
+                continue
+            if not options['loop']:
+                break
+            # Either nothing is due, or nothing could be sent and should not
+            # be retried right away
+            time.sleep(options['sleep'])
+
+        if options['verbosity'] > 0:
+            self.stdout.write('Sent %s messages, %s failed' %
+                              (total_sent, total_failed))
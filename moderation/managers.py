@@ -7,8 +7,9 @@ from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 
 from . import moderation
 from .constants import MODERATION_READY_STATE
-from .queryset import ModeratedObjectQuerySet
-from .utils import django_17, django_18, django_110
+from .queryset import (ModeratedObjectQuerySet,
+                       get_moderated_queryset_class)
+from .utils import django_17, django_18
 
 
 class MetaClass(type(Manager)):
@@ -32,17 +33,15 @@ class ModerationObjectsManager(Manager):
             (self.__class__, base_manager),
             {'use_for_related_fields': True})
 
-    if django_110():
+    if django_18():
         def filter_moderated_objects(self, queryset):
-            # Find any objects that have more than one related ModeratedObject
-            annotated_queryset = queryset\
-                .annotate(num_moderation_objects=Count('_relation_object'))\
-                .filter(num_moderation_objects__gt=1)
-
-            if annotated_queryset.exists():
-                # No sensible default action here. You need to override
-                # filter_moderated_objects() to handle this as you see fit.
-                raise self.MultipleModerations(annotated_queryset)
+            if self._check_multiple_moderations():
+                annotated_queryset = self.find_multiple_moderations(queryset)
+                if annotated_queryset.exists():
+                    # No sensible default action here. You need to override
+                    # filter_moderated_objects() to handle this as you see
+                    # fit.
+                    raise self.MultipleModerations(annotated_queryset)
 
             only_no_relation_objects = {
                 '_relation_object': None,
@@ -52,26 +51,16 @@ class ModerationObjectsManager(Manager):
             }
             return queryset.filter(Q(**only_no_relation_objects) | Q(**only_ready))
 
-    elif django_18():
-        def filter_moderated_objects(self, queryset):
-            # Find any objects that have more than one related ModeratedObject
-            annotated_queryset = queryset\
+        def find_multiple_moderations(self, queryset):
+            """
+            Returns the objects of queryset that have more than one related
+            ModeratedObject. This groups the whole table, so it is best run
+            from a periodic task rather than on every query.
+            """
+            return queryset\
                 .annotate(num_moderation_objects=Count('_relation_object'))\
                 .filter(num_moderation_objects__gt=1)
 
-            if annotated_queryset.exists():
-                # No sensible default action here. You need to override
-                # filter_moderated_objects() to handle this as you see fit.
-                raise self.MultipleModerations(annotated_queryset)
-
-            only_no_relation_objects = {
-                '_relation_object': None,
-            }
-            only_ready = {
-                '_relation_object__state': MODERATION_READY_STATE,
-            }
-            return queryset.filter(Q(**only_no_relation_objects) | Q(**only_ready))
-
     else:
         # Django < 1.7 doesn't properly annotate using GenericRelation fields,
         # so we keep a copy of the old code, even though it runs N+1 queries
@@ -88,8 +77,9 @@ class ModerationObjectsManager(Manager):
 
             # TODO: Load this query in chunks to avoid huge RAM usage spikes
             mobjects = {}
+            check = self._check_multiple_moderations()
             for mobject in mobjs_set:
-                if mobject.object_pk in mobjects:
+                if check and mobject.object_pk in mobjects:
                     # No sensible default action here. You need to override
                     # filter_moderated_objects() to handle this as you see fit.
                     raise self.MultipleModerations(mobject)
@@ -112,9 +102,29 @@ class ModerationObjectsManager(Manager):
 
             return query_set.exclude(pk__in=exclude_pks)
 
+    def _check_multiple_moderations(self):
+        check = self.moderator.check_multiple_moderations
+        if check is None:
+            # Only keep_history leaves several moderations per object, which
+            # the join would return more than once, and show while any of
+            # them is ready
+            return self.moderator.keep_history
+        return check
+
+    def with_moderation(self):
+        """
+        Returns the queryset with the most recent ModeratedObject of every
+        object prefetched, see ModeratedQuerySetMixin.with_moderation()
+        """
+        return self.get_queryset().with_moderation()
+
     def exclude_objs_by_visibility_col(self, query_set):
         return query_set.exclude(**{self.moderator.visibility_column: False})
 
+    def filter_objs_by_state_col(self, query_set):
+        return query_set.filter(
+            **{self.moderator.state_column: MODERATION_READY_STATE})
+
     def get_queryset(self):
         query_set = None
 
@@ -123,9 +133,16 @@ class ModerationObjectsManager(Manager):
         except AttributeError:
             query_set = super(ModerationObjectsManager, self).get_query_set()
 
+        # Adds with_moderation() to the querysets of the base manager
+        query_set.__class__ = get_moderated_queryset_class(
+            query_set.__class__)
+
         if self.moderator.visibility_column:
             return self.exclude_objs_by_visibility_col(query_set)
 
+        if self.moderator.state_column:
+            return self.filter_objs_by_state_col(query_set)
+
         return self.filter_moderated_objects(query_set)
 
     if not django_17():
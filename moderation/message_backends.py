@@ -1,6 +1,28 @@
 from __future__ import unicode_literals
+
+import atexit
+import datetime
+import logging
+import smtplib
+import socket
+import threading
+import uuid
+from timeit import default_timer
+
 from django.conf import settings
-from django.core.mail import send_mail, send_mass_mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import (EmailMessage, get_connection, send_mail,
+                              send_mass_mail)
+from django.db.models import F, Q
+from django.utils import timezone
+
+try:
+    from concurrent.futures import ThreadPoolExecutor, wait
+except ImportError:
+    # Python 2 without the futures package
+    ThreadPoolExecutor = None
+
+logger = logging.getLogger(__name__)
 
 
 class BaseMessageBackend(object):
@@ -12,6 +34,12 @@ class BaseMessageBackend(object):
 class BaseMultipleMessageBackend(BaseMessageBackend):
     """Used to send mail to multiple users"""
 
+    def open(self):
+        """Called before sending several batches with the same backend"""
+
+    def close(self):
+        """Called after the last batch was sent"""
+
 
 class SyncMessageBackend(BaseMessageBackend):
     """Synchronous backend"""
@@ -38,17 +66,490 @@ class EmailMessageBackend(SyncMessageBackend):
                   fail_silently=True)
 
 
-class EmailMultipleMessageBackend(SyncMessageBackend):
+class EmailMultipleMessageBackend(SyncMessageBackend,
+                                  BaseMultipleMessageBackend):
     """
-    Send messages through emails on the main thread
+    Send messages through emails on the main thread. Between open() and
+    close(), all batches are sent over the same connection. send() returns
+    the number of sent messages.
     """
+    connection = None
+
+    def open(self):
+        self.connection = get_connection(fail_silently=True)
+        self.connection.open()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
     def send(self, datatuples, **kwargs):
-        send_mass_mail(
-            tuple(tuple(
+        return send_mass_mail(
+            tuple((
                 d.get('subject', None),
                 d.get('message', None),
                 settings.DEFAULT_FROM_EMAIL,
                 d.get('recipient_list', None))
                 for d in datatuples),
-            fail_silently=True)
+            fail_silently=True,
+            connection=self.connection) or 0
+
+
+class QueuedEmailMessageBackend(AsyncMessageBackend):
+    """
+    Store the message in the database, to be sent by the
+    send_moderation_messages management command
+    """
+
+    def send(self, **kwargs):
+        from .models import QueuedMessage
+
+        queued_message = QueuedMessage(
+            subject=kwargs.get('subject', None),
+            message=kwargs.get('message', None),
+            from_email=settings.DEFAULT_FROM_EMAIL)
+        queued_message.recipient_list = \
+            kwargs.get('recipient_list', None) or []
+        queued_message.save()
+
+
+class QueuedEmailMultipleMessageBackend(AsyncMessageBackend,
+                                        BaseMultipleMessageBackend):
+    """
+    Store the messages in the database, to be sent by the
+    send_moderation_messages management command
+    """
+
+    def send(self, datatuples, **kwargs):
+        from .models import QueuedMessage
+
+        queued_messages = []
+        for d in datatuples:
+            queued_message = QueuedMessage(
+                subject=d.get('subject', None),
+                message=d.get('message', None),
+                from_email=settings.DEFAULT_FROM_EMAIL)
+            queued_message.recipient_list = d.get('recipient_list', None) or []
+            queued_messages.append(queued_message)
+
+        QueuedMessage.objects.bulk_create(queued_messages)
+
+
+def send_queued_messages(batch_size=100, max_attempts=3, connection=None,
+                         claim_timeout=600, retry_delay=60):
+    """
+    Sends up to batch_size messages stored by the queued backends over a
+    single connection, and returns the numbers of sent and failed ones.
+    Failed messages stay queued with their error, and are given up on
+    once they failed max_attempts times. Until then they are tried again
+    after retry_delay seconds, doubled with every failed attempt.
+
+    The messages are claimed before they are sent, so several workers can
+    run at once. Claims older than claim_timeout seconds, left by workers
+    that died, are taken over.
+    """
+    from .models import QueuedMessage
+
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=claim_timeout)
+    claimable = QueuedMessage.objects.filter(
+        Q(claimed=None) | Q(claimed__lt=stale),
+        Q(next_attempt=None) | Q(next_attempt__lte=now),
+        attempts__lt=max_attempts)
+    pks = list(claimable.order_by('attempts', 'created')
+                        .values_list('pk', flat=True)[:batch_size])
+    if not pks:
+        return 0, 0
+
+    # The conditions are checked again by the UPDATE, so a message taken by
+    # another worker in the meantime is left alone
+    claim = uuid.uuid4().hex
+    claimable.filter(pk__in=pks).update(claim=claim, claimed=timezone.now())
+    queued_messages = list(QueuedMessage.objects.filter(claim=claim)
+                                                .order_by('attempts',
+                                                          'created'))
+    if not queued_messages:
+        return 0, 0
+
+    connection = connection or get_connection()
+    sent = []
+    failed = []
+    try:
+        connection.open()
+    except Exception as e:
+        failed = [(queued_message, e) for queued_message in queued_messages]
+    else:
+        try:
+            for queued_message in queued_messages:
+                email = EmailMessage(queued_message.subject,
+                                     queued_message.message,
+                                     queued_message.from_email,
+                                     queued_message.recipient_list,
+                                     connection=connection)
+                try:
+                    email.send()
+                except Exception as e:
+                    failed.append((queued_message, e))
+                else:
+                    sent.append(queued_message.pk)
+        finally:
+            connection.close()
+
+    QueuedMessage.objects.filter(pk__in=sent).delete()
+    for queued_message, error in failed:
+        delay = retry_delay * 2 ** queued_message.attempts
+        QueuedMessage.objects.filter(pk=queued_message.pk).update(
+            attempts=F('attempts') + 1,
+            last_error='%s: %s' % (error.__class__.__name__, error),
+            next_attempt=timezone.now() + datetime.timedelta(seconds=delay),
+            claim='', claimed=None)
+
+    return len(sent), len(failed)
+
+
+def _is_connection_error(error):
+    # SMTPException is a subclass of socket.error on Python 3
+    return isinstance(error, smtplib.SMTPServerDisconnected) or (
+        isinstance(error, socket.error) and
+        not isinstance(error, smtplib.SMTPException))
+
+
+def _send_each(connection, messages):
+    """
+    Sends the EmailMessages one at a time over the open connection, and
+    returns the number of sent ones with the error that stopped the sending
+    """
+    sent = 0
+    for message in messages:
+        try:
+            sent += connection.send_messages([message]) or 0
+        except Exception as e:
+            return sent, e
+    return sent, None
+
+
+class ThreadPoolDelivery(object):
+    """
+    Sends emails from a bounded pool of threads, each keeping its own
+    connection to the mail server open, and counts the queued, sent and
+    failed ones.
+    """
+
+    def __init__(self, max_workers, max_queued):
+        if ThreadPoolExecutor is None:
+            raise ImproperlyConfigured(
+                "The threaded message backends require the futures package "
+                "on Python 2")
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Submitting blocks once this many batches are waiting or running
+        self.slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.futures = set()
+
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+
+    @property
+    def pending(self):
+        return self.queued - self.sent - self.failed
+
+    def submit(self, messages):
+        """Hands the EmailMessages to a worker thread"""
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._send, messages)
+        except Exception:
+            # Shut down
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.queued += len(messages)
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+        self.slots.release()
+
+    def _get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = get_connection()
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def _send(self, messages):
+        sent = 0
+        error = None
+        try:
+            connection = self._get_connection()
+        except Exception as e:
+            error = e
+            # Count the messages as failed below, there is nothing to send
+            # them over
+            attempts = 0
+        else:
+            attempts = 2
+        # Reconnect once, as the server may have closed an idle connection,
+        # but only when nothing was sent, so no message goes out twice
+        for attempt in range(attempts):
+            try:
+                connection.open()
+            except Exception as e:
+                error = e
+                continue
+            sent, error = _send_each(connection, messages)
+            if error is None:
+                break
+            try:
+                connection.close()
+            except Exception:
+                pass
+            if sent or not _is_connection_error(error):
+                break
+
+        with self.lock:
+            self.sent += sent
+            self.failed += len(messages) - sent
+
+        if error is not None:
+            logger.error('Sending %s moderation emails failed: %s',
+                         len(messages) - sent, error)
+
+    def flush(self, timeout=None):
+        """Waits until the messages submitted so far have been handled"""
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures, timeout=timeout)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        for connection in self.connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+_delivery = None
+_delivery_lock = threading.Lock()
+
+
+def get_thread_pool_delivery():
+    """
+    Returns the ThreadPoolDelivery shared by the threaded message backends,
+    which is shut down when the process exits
+    """
+    global _delivery
+
+    if _delivery is None:
+        with _delivery_lock:
+            if _delivery is None:
+                from .conf.settings import (THREADED_MAX_WORKERS,
+                                            THREADED_MAX_QUEUED)
+
+                delivery = ThreadPoolDelivery(THREADED_MAX_WORKERS,
+                                              THREADED_MAX_QUEUED)
+                atexit.register(delivery.shutdown)
+                _delivery = delivery
+    return _delivery
+
+
+class ThreadedEmailMessageBackend(AsyncMessageBackend):
+    """
+    Send the message through an email from a pool of worker threads
+    """
+
+    def send(self, **kwargs):
+        get_thread_pool_delivery().submit([EmailMessage(
+            kwargs.get('subject', None),
+            kwargs.get('message', None),
+            settings.DEFAULT_FROM_EMAIL,
+            kwargs.get('recipient_list', None))])
+
+
+class ThreadedEmailMultipleMessageBackend(AsyncMessageBackend,
+                                          BaseMultipleMessageBackend):
+    """
+    Send messages through emails from a pool of worker threads
+    """
+
+    def send(self, datatuples, **kwargs):
+        messages = [EmailMessage(
+            d.get('subject', None),
+            d.get('message', None),
+            settings.DEFAULT_FROM_EMAIL,
+            d.get('recipient_list', None))
+            for d in datatuples]
+
+        if messages:
+            get_thread_pool_delivery().submit(messages)
+
+
+class ConnectionPool(object):
+    """
+    Keeps a connection to the mail server open in each thread, reopening it
+    when it was unused for idle_timeout seconds or sending over it fails,
+    and measures the time spent sending.
+    """
+
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+        self.sent = 0
+        self.failed = 0
+        self.batches = 0
+        self.send_time = 0.0
+        self.max_send_time = 0.0
+
+    @property
+    def average_send_time(self):
+        if not self.batches:
+            return 0.0
+        return self.send_time / self.batches
+
+    def _get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and \
+                default_timer() - self.local.last_used > self.idle_timeout:
+            self._close_connection()
+            connection = None
+
+        if connection is None:
+            connection = self.local.connection = get_connection()
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def _close_connection(self):
+        connection = self.local.connection
+        self.local.connection = None
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def send_messages(self, messages):
+        """
+        Sends the EmailMessages and returns the number of sent ones. Errors
+        are logged instead of raised.
+        """
+        start = default_timer()
+        sent = 0
+        error = None
+        # Reconnect once, as the server may have closed the connection, but
+        # only when nothing was sent, so no message goes out twice
+        for attempt in range(2):
+            try:
+                connection = self._get_connection()
+            except Exception as e:
+                # The backend itself can't be set up, so don't try again
+                error = e
+                break
+            try:
+                connection.open()
+            except Exception as e:
+                error = e
+                self._close_connection()
+                continue
+            sent, error = _send_each(connection, messages)
+            if error is None:
+                break
+            self._close_connection()
+            if sent or not _is_connection_error(error):
+                break
+        self.local.last_used = default_timer()
+        elapsed = self.local.last_used - start
+
+        with self.lock:
+            self.sent += sent
+            self.failed += len(messages) - sent
+            self.batches += 1
+            self.send_time += elapsed
+            self.max_send_time = max(self.max_send_time, elapsed)
+
+        if error is not None:
+            logger.error('Sending %s moderation emails failed: %s',
+                         len(messages) - sent, error)
+        logger.debug('Sent %s of %s moderation emails in %.3fs',
+                     sent, len(messages), elapsed)
+        return sent
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """
+    Returns the ConnectionPool shared by the pooled message backends, whose
+    connections are closed when the process exits
+    """
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from .conf.settings import POOLED_IDLE_TIMEOUT
+
+                pool = ConnectionPool(POOLED_IDLE_TIMEOUT)
+                atexit.register(pool.close)
+                _pool = pool
+    return _pool
+
+
+class PooledEmailMessageBackend(SyncMessageBackend):
+    """
+    Send the message through an email on the main thread, over a connection
+    kept open between notifications
+    """
+
+    def send(self, **kwargs):
+        get_connection_pool().send_messages([EmailMessage(
+            kwargs.get('subject', None),
+            kwargs.get('message', None),
+            settings.DEFAULT_FROM_EMAIL,
+            kwargs.get('recipient_list', None))])
+
+
+class PooledEmailMultipleMessageBackend(SyncMessageBackend,
+                                        BaseMultipleMessageBackend):
+    """
+    Send messages through emails on the main thread, over a connection kept
+    open between notifications. send() returns the number of sent messages.
+    """
+
+    def send(self, datatuples, **kwargs):
+        messages = [EmailMessage(
+            d.get('subject', None),
+            d.get('message', None),
+            settings.DEFAULT_FROM_EMAIL,
+            d.get('recipient_list', None))
+            for d in datatuples]
+
+        if not messages:
+            return 0
+        return get_connection_pool().send_messages(messages)
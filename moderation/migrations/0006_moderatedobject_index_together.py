@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('moderation', '0005_auto_20190412_0442'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='moderatedobject',
+            index_together=set([
+                ('content_type', 'object_pk', 'updated'),
+                ('content_type', 'object_pk', 'state'),
+                ('status', 'created'),
+            ]),
+        ),
+    ]
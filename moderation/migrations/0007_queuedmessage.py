@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0006_moderatedobject_index_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedMessage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('subject', models.TextField()),
+                ('message', models.TextField()),
+                ('from_email', models.CharField(max_length=254)),
+                ('recipients', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('next_attempt', models.DateTimeField(null=True, blank=True)),
+                ('claim', models.CharField(max_length=32, blank=True)),
+                ('claimed', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+                'verbose_name': 'Queued Message',
+                'verbose_name_plural': 'Queued Messages',
+                'ordering': ['created'],
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='queuedmessage',
+            index_together=set([('attempts', 'created')]),
+        ),
+    ]
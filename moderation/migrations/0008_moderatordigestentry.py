@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0007_queuedmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModeratorDigestEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('claim', models.CharField(max_length=32, blank=True)),
+                ('claimed', models.DateTimeField(null=True, blank=True)),
+                ('moderated_object', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='digest_entry', to='moderation.ModeratedObject')),
+            ],
+            options={
+                'verbose_name': 'Moderator Digest Entry',
+                'verbose_name_plural': 'Moderator Digest Entries',
+                'ordering': ['created'],
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from ..fields import SerializedObjectField
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('moderation', '0008_moderatordigestentry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='moderatedobject',
+            name='changed_object',
+            field=SerializedObjectField(editable=False, lazy=True),
+        ),
+    ]
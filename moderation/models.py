@@ -17,13 +17,14 @@ from .constants import (MODERATION_READY_STATE,
                         MODERATION_STATUS_REJECTED,
                         MODERATION_STATUS_APPROVED,
                         MODERATION_STATUS_PENDING)
-from .diff import get_changes_between_models
+from .diff import iter_changed_fields
 from .fields import SerializedObjectField
 from .managers import ModeratedObjectManager
 from .signals import post_moderation, pre_moderation
 from .utils import django_19
 
 import datetime
+import json
 
 
 MODERATION_STATES = Choices(
@@ -62,6 +63,7 @@ class ModeratedObject(models.Model):
     on = models.DateTimeField(editable=False, blank=True, null=True)
     reason = models.TextField(blank=True, null=True)
     changed_object = SerializedObjectField(serialize_format='json',
+                                           lazy=True,
                                            editable=False)
     changed_by = models.ForeignKey(
         getattr(settings, 'AUTH_USER_MODEL', 'auth.User'),
@@ -75,6 +77,10 @@ class ModeratedObject(models.Model):
     def __init__(self, *args, **kwargs):
         self.instance = kwargs.get('content_object')
         super(ModeratedObject, self).__init__(*args, **kwargs)
+        # Missing when the field is deferred
+        self._saved_state = self.__dict__.get('state')
+        # State written to the state_column by the last save(), if any
+        self._mirrored_state = None
 
     def __unicode__(self):
         return "%s" % self.changed_object
@@ -86,12 +92,25 @@ class ModeratedObject(models.Model):
         if self.instance:
             self.changed_object = self.instance
 
+        state_changed = (self._state.adding or
+                         self.state != self._saved_state)
         super(ModeratedObject, self).save(*args, **kwargs)
+        self._saved_state = self.state
+        self._mirrored_state = \
+            self._update_state_column() if state_changed else None
 
     class Meta:
         verbose_name = _('Moderated Object')
         verbose_name_plural = _('Moderated Objects')
         ordering = ['status', 'created']
+        index_together = [
+            # ModeratedObjectManager.get_for_instance()
+            ('content_type', 'object_pk', 'updated'),
+            # The _relation_object join of ModerationObjectsManager
+            ('content_type', 'object_pk', 'state'),
+            # Default ordering, used by the admin changelist
+            ('status', 'created'),
+        ]
 
     def automoderate(self, user=None):
         '''Auto moderate object for given user.
@@ -137,7 +156,13 @@ class ModeratedObject(models.Model):
 
     def get_object_for_this_type(self):
         pk = self.object_pk
-        obj = self.content_type.model_class()._default_unmoderated_manager.get(pk=pk)
+        entry = moderation.get_registry_entry(self.content_type_id)
+        if entry is None:
+            manager = self.content_type.model_class()\
+                ._default_unmoderated_manager
+        else:
+            manager = entry.unmoderated_manager
+        obj = manager.get(pk=pk)
         return obj
 
     def get_absolute_url(self):
@@ -153,9 +178,49 @@ class ModeratedObject(models.Model):
 
     @property
     def moderator(self):
-        model_class = self.content_type.model_class()
-
-        return moderation.get_moderator(model_class)
+        entry = moderation.get_registry_entry(self.content_type_id)
+        if entry is None:
+            # Raises RegistrationError
+            return moderation.get_moderator(self.content_type.model_class())
+
+        return entry.moderator
+
+    def _get_state_column_value(self, deleted=False):
+        """
+        Returns the state the state_column of the moderated object should
+        hold, like the join on ModeratedObject of the moderated manager:
+        objects are visible without any moderation, or while one of their
+        moderations is ready, which keep_history may leave behind.
+        """
+        if not deleted and self.state == MODERATION_READY_STATE:
+            return MODERATION_READY_STATE
+
+        states = set(ModeratedObject.objects
+                     .filter(content_type_id=self.content_type_id,
+                             object_pk=self.object_pk)
+                     .exclude(pk=self.pk)
+                     .values_list('state', flat=True))
+        if MODERATION_READY_STATE in states or (deleted and not states):
+            return MODERATION_READY_STATE
+        return MODERATION_DRAFT_STATE
+
+    def _update_state_column(self, deleted=False):
+        """
+        Mirrors the visibility given by state to the state_column of the
+        moderated object. Returns the state written, or None.
+        """
+        if self.object_pk is None:
+            return None
+
+        entry = moderation.get_registry_entry(self.content_type_id)
+        if entry is None or not entry.moderator.state_column:
+            return None
+
+        state = self._get_state_column_value(deleted)
+        entry.unmoderated_manager\
+            .filter(pk=self.object_pk)\
+            .update(**{entry.moderator.state_column: state})
+        return state
 
     def _send_signals_and_moderate(self, new_status, by, reason):
         pre_moderation.send(sender=self.changed_object.__class__,
@@ -217,6 +282,11 @@ class ModeratedObject(models.Model):
                 base_object_force_save = True
 
         if base_object_force_save:
+            if self.moderator.state_column:
+                # Saved after the state column was updated
+                setattr(base_object, self.moderator.state_column,
+                        self._get_state_column_value())
+
             # avoid triggering pre/post_save_handler
             with transaction.atomic(using=None, savepoint=False):
                 base_object.save_base(raw=True)
@@ -228,26 +298,115 @@ class ModeratedObject(models.Model):
             self.moderator.inform_user(self.content_object, self.changed_by)
 
     def has_object_been_changed(self, original_obj, only_excluded=False):
-        excludes = includes = []
+        excludes = self._get_untracked_fields()
+        includes = []
         if only_excluded:
             includes = self.moderator.fields_exclude
         else:
-            excludes = self.moderator.fields_exclude
-
-        changes = get_changes_between_models(original_obj,
-                                             self.changed_object,
-                                             excludes,
-                                             includes)
+            excludes += self.moderator.fields_exclude
 
-        for change in changes:
-            left_change, right_change = changes[change].change
-            if left_change != right_change:
-                return True
+        for field_name in iter_changed_fields(original_obj,
+                                              self.changed_object,
+                                              excludes,
+                                              includes):
+            return True
 
         return False
 
+    def _get_changed_fields(self, original_obj):
+        """
+        Returns the set of names of fields whose values differ between
+        original_obj and changed_object, moderated or not, in one pass.
+        """
+        return set(iter_changed_fields(original_obj, self.changed_object,
+                                       self._get_untracked_fields()))
+
+    def _get_untracked_fields(self):
+        """
+        Returns the names of the fields that are written to the table
+        directly, and so may differ from changed_object without a change
+        """
+        state_column = self.moderator.state_column
+        return [state_column] if state_column else []
+
     def approve(self, by=None, reason=None):
         self._send_signals_and_moderate(MODERATION_STATUS_APPROVED, by, reason)
 
     def reject(self, by=None, reason=None):
         self._send_signals_and_moderate(MODERATION_STATUS_REJECTED, by, reason)
+
+
+def update_state_column(sender, instance, **kwargs):
+    instance._update_state_column(deleted=True)
+
+
+models.signals.post_delete.connect(
+    update_state_column, sender=ModeratedObject,
+    dispatch_uid='moderation_update_state_column')
+
+
+class QueuedMessage(models.Model):
+    """
+    Notification waiting to be sent by the send_moderation_messages
+    management command, stored by the queued message backends.
+    """
+    subject = models.TextField()
+    message = models.TextField()
+    from_email = models.CharField(max_length=254)
+    # JSON list of addresses
+    recipients = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # Not tried again before, set when sending fails
+    next_attempt = models.DateTimeField(null=True, blank=True)
+    # Set by the worker sending the message, see send_queued_messages()
+    claim = models.CharField(max_length=32, blank=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Queued Message')
+        verbose_name_plural = _('Queued Messages')
+        ordering = ['created']
+        index_together = [
+            ('attempts', 'created'),
+        ]
+
+    def __unicode__(self):
+        return "%s" % self.subject
+
+    def __str__(self):
+        return "%s" % self.subject
+
+    @property
+    def recipient_list(self):
+        return json.loads(self.recipients)
+
+    @recipient_list.setter
+    def recipient_list(self, value):
+        self.recipients = json.dumps(list(value))
+
+
+class ModeratorDigestEntry(models.Model):
+    """
+    Change waiting to be included in the next digest sent to moderators, by
+    moderators with moderator_digest enabled
+    """
+    moderated_object = models.OneToOneField(ModeratedObject,
+                                            on_delete=models.CASCADE,
+                                            related_name='digest_entry')
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Set by the call sending the digest, see GenericModerator.send_digest()
+    claim = models.CharField(max_length=32, blank=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Moderator Digest Entry')
+        verbose_name_plural = _('Moderator Digest Entries')
+        ordering = ['created']
+
+    def __unicode__(self):
+        return "%s" % self.moderated_object
+
+    def __str__(self):
+        return "%s" % self.moderated_object
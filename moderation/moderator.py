@@ -1,16 +1,168 @@
 from __future__ import unicode_literals
+import datetime
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.core.exceptions import ObjectDoesNotExist
-from django.db.models.fields import BooleanField
+from django.core.cache import caches
+from django.db.models.fields import BooleanField, DateField, IntegerField
+from django.db.models.fields.files import FileField
+from django.db.models import Count, Min, Q, signals
 from django.db.models.manager import Manager
-from django.template.loader import render_to_string
-
+from django.template import Context, loader
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+from django.utils import timezone
+
+from .constants import MODERATION_STATUS_PENDING
 from .managers import ModerationObjectsManager
 from .message_backends import (BaseMessageBackend,
                                EmailMessageBackend,
                                BaseMultipleMessageBackend,
                                EmailMultipleMessageBackend)
+from .utils import django_18
+
+
+GROUP_IDS_CACHE_KEY = 'moderation-group-ids'
+
+
+def get_group_ids(names):
+    """
+    Returns the set of ids of the groups with the given names. Names found
+    are kept in the MODERATION_GROUP_CACHE cache, so groups renamed, deleted
+    or created by other processes are seen once the entry times out.
+    """
+    from .conf.settings import GROUP_CACHE, GROUP_CACHE_TIMEOUT
+
+    if GROUP_CACHE is None:
+        return set(Group.objects.filter(name__in=names)
+                                .values_list('id', flat=True))
+
+    cache = caches[GROUP_CACHE]
+    group_ids = cache.get(GROUP_IDS_CACHE_KEY) or {}
+    missing = [name for name in names if name not in group_ids]
+    if missing:
+        found = dict(Group.objects.filter(name__in=missing)
+                                  .values_list('name', 'id'))
+        if found:
+            group_ids.update(found)
+            cache.set(GROUP_IDS_CACHE_KEY, group_ids, GROUP_CACHE_TIMEOUT)
+
+    return set(group_ids[name] for name in names if name in group_ids)
+
+
+def clear_group_ids(**kwargs):
+    from .conf.settings import GROUP_CACHE
+
+    if GROUP_CACHE is not None:
+        caches[GROUP_CACHE].delete(GROUP_IDS_CACHE_KEY)
+
+
+signals.post_save.connect(clear_group_ids, sender=Group,
+                          dispatch_uid='moderation_clear_group_ids')
+signals.post_delete.connect(clear_group_ids, sender=Group,
+                            dispatch_uid='moderation_clear_group_ids')
+
+
+# Bumped whenever users are added to or removed from groups, which makes
+# the group ids remembered on user instances stale
+_user_groups_version = 0
+
+
+def clear_user_group_ids(action, **kwargs):
+    global _user_groups_version
+
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        _user_groups_version += 1
+
+
+def connect_user_group_signals():
+    """
+    Connects clear_user_group_ids to the group memberships of the user
+    model, which is only known once the app registry is ready
+    """
+    groups = getattr(get_user_model(), 'groups', None)
+    if groups is None:
+        # A custom user model without groups
+        return
+
+    signals.m2m_changed.connect(clear_user_group_ids, sender=groups.through,
+                                dispatch_uid='moderation_clear_user_group_ids')
+
+
+# Template name -> compiled template, so notifications don't go through the
+# template loaders every time. Cleared when the template settings change, and
+# not used with DEBUG, so edited templates are picked up during development.
+_templates = {}
+
+
+def get_template(template_name):
+    """Returns the compiled template with the given name"""
+    if settings.DEBUG:
+        return loader.get_template(template_name)
+    try:
+        return _templates[template_name]
+    except KeyError:
+        template = _templates[template_name] = \
+            loader.get_template(template_name)
+        return template
+
+
+def render_template(template_name, context):
+    template = get_template(template_name)
+    if not django_18():
+        context = Context(context)
+    return template.render(context)
+
+
+def clear_templates(setting, **kwargs):
+    if setting.startswith('TEMPLATE'):
+        _templates.clear()
+
+
+setting_changed.connect(clear_templates,
+                        dispatch_uid='moderation_clear_templates')
+
+
+# SITE_ID -> Site. Unlike the cache of Site.objects.get_current(), only
+# cleared when a site is saved or deleted, or when SITE_ID changes.
+_sites = {}
+
+
+def get_current_site():
+    """
+    Returns the current Site like Site.objects.get_current(). Notifications
+    are sent without a request, so the site is given by the SITE_ID setting.
+    """
+    site_id = getattr(settings, 'SITE_ID', None)
+    try:
+        return _sites[site_id]
+    except KeyError:
+        # Raises ImproperlyConfigured without SITE_ID
+        site = _sites[site_id] = Site.objects.get_current()
+        return site
+
+
+def clear_sites(**kwargs):
+    _sites.clear()
+
+
+def clear_sites_for_setting(setting, **kwargs):
+    if setting == 'SITE_ID':
+        _sites.clear()
+
+
+signals.post_save.connect(clear_sites, sender=Site,
+                          dispatch_uid='moderation_clear_sites')
+signals.post_delete.connect(clear_sites, sender=Site,
+                            dispatch_uid='moderation_clear_sites')
+setting_changed.connect(clear_sites_for_setting,
+                        dispatch_uid='moderation_clear_sites_for_setting')
 
 
 class GenericModerator(object):
@@ -23,11 +175,15 @@ class GenericModerator(object):
     bypass_moderation_after_approval = False
     visible_until_rejected = False
     keep_history = False
+    per_object_signals = False
+    # None checks for keep_history only
+    check_multiple_moderations = None
 
     fields_exclude = []
     resolve_foreignkeys = True
 
     visibility_column = None
+    state_column = None
 
     auto_approve_for_superusers = True
     auto_approve_for_staff = True
@@ -38,6 +194,15 @@ class GenericModerator(object):
 
     notify_moderator = True
     notify_user = True
+    # Number of user notifications rendered and sent at once by inform_users
+    notification_batch_size = 100
+
+    # Collect the notifications to moderators, to be sent as one digest by
+    # the send_moderation_digests command after digest_interval seconds or
+    # digest_max_size changes
+    moderator_digest = False
+    digest_interval = 3600
+    digest_max_size = 100
 
     message_backend_class = EmailMessageBackend
     multiple_message_backend_class = EmailMultipleMessageBackend
@@ -47,6 +212,10 @@ class GenericModerator(object):
         'moderation/notification_message_moderator.txt'
     subject_template_user = 'moderation/notification_subject_user.txt'
     message_template_user = 'moderation/notification_message_user.txt'
+    subject_template_digest = \
+        'moderation/notification_subject_digest_moderator.txt'
+    message_template_digest = \
+        'moderation/notification_message_digest_moderator.txt'
 
     def __init__(self, model_class):
         self.model_class = model_class
@@ -59,6 +228,8 @@ class GenericModerator(object):
                 if field.name not in moderated_fields:
                     self.fields_exclude.append(field.name)
 
+        self.save_mutated_fields = self._get_save_mutated_fields()
+
     def is_auto_approve(self, obj, user):
         '''
         Checks if change on obj by user need to be auto approved
@@ -103,16 +274,20 @@ class GenericModerator(object):
         return reason
 
     def _check_user_in_groups(self, user, groups):
-        for group in groups:
-            try:
-                group = Group.objects.get(name=group)
-            except ObjectDoesNotExist:
-                return False
+        group_ids = get_group_ids(groups)
+        if not group_ids:
+            return False
 
-            if group in user.groups.all():
-                return True
+        # Kept on the user, which usually lives as long as the request,
+        # until the members of any group change
+        version, user_group_ids = getattr(user, '_moderation_group_ids',
+                                          (None, None))
+        if version != _user_groups_version:
+            user_group_ids = set(user.groups.values_list('id', flat=True))
+            user._moderation_group_ids = (_user_groups_version,
+                                          user_group_ids)
 
-        return False
+        return not group_ids.isdisjoint(user_group_ids)
 
     def get_message_backend(self):
         if not issubclass(self.message_backend_class, BaseMessageBackend):
@@ -125,22 +300,26 @@ class GenericModerator(object):
         if not issubclass(self.multiple_message_backend_class, BaseMultipleMessageBackend):
             raise TypeError("The message backend used '{}' needs to "
                             "inherit from the BaseMultipleMessageBackend "
-                            "class".format(self.message_backend_class))
+                            "class".format(
+                                self.multiple_message_backend_class))
         return self.multiple_message_backend_class()
 
     def send(self, content_object, subject_template, message_template,
              recipient_list, extra_context=None):
+        moderated_object = content_object.moderated_object
         context = {
-            'moderated_object': content_object.moderated_object,
+            'moderated_object': moderated_object,
             'content_object': content_object,
-            'site': Site.objects.get_current(),
-            'content_type': content_object.moderated_object.content_type}
+            'site': get_current_site(),
+            # From the content type cache rather than the foreign key
+            'content_type': ContentType.objects.get_for_id(
+                moderated_object.content_type_id)}
 
         if extra_context:
             context.update(extra_context)
 
-        message = render_to_string(message_template, context)
-        subject = render_to_string(subject_template, context)
+        message = render_template(message_template, context)
+        subject = render_template(subject_template, context)
 
         backend = self.get_message_backend()
         backend.send(
@@ -150,33 +329,45 @@ class GenericModerator(object):
 
     def send_many(self, queryset, subject_template, message_template,
                   extra_context=None):
-        site = Site.objects.get_current()
-
-        ctx = extra_context if extra_context else {}
-
-        datatuples = tuple({
-            'subject': render_to_string(
-                subject_template, ctx.update({
-                    'moderated_object': mobj,
-                    'content_object': mobj.content_object,
-                    'site': site,
-                    'content_type': mobj.content_type,
-                    'user': mobj.changed_by,
-                })),
-            'message': render_to_string(
-                message_template, ctx.update({
-                    'moderated_object': mobj,
-                    'content_object': mobj.content_object,
-                    'site': site,
-                    'content_type': mobj.content_type,
-                    'user': mobj.changed_by,
-                })),
-            # from_email will need to be added
-            'recipient_list': [mobj.changed_by.email]
-        } for mobj in queryset)
+        # Shared by the messages of all objects
+        base_context = {
+            'site': get_current_site(),
+            'content_type': ContentType.objects.get_for_model(
+                self.model_class),
+        }
+
+        queryset = queryset.select_related('changed_by')\
+                           .prefetch_related('content_object')
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+        if not pks:
+            return
 
         multiple_backend = self.get_multiple_message_backend()
-        multiple_backend.send(datatuples)
+        multiple_backend.open()
+        try:
+            for start in range(0, len(pks), self.notification_batch_size):
+                batch = queryset.filter(
+                    pk__in=pks[start:start + self.notification_batch_size])
+
+                datatuples = []
+                for mobj in batch:
+                    context = dict(base_context,
+                                   moderated_object=mobj,
+                                   content_object=mobj.content_object,
+                                   user=mobj.changed_by)
+                    # Like in send(), extra_context wins over the defaults
+                    if extra_context:
+                        context.update(extra_context)
+                    datatuples.append({
+                        'subject': render_template(subject_template, context),
+                        'message': render_template(message_template, context),
+                        # from_email will need to be added
+                        'recipient_list': [mobj.changed_by.email],
+                    })
+
+                multiple_backend.send(tuple(datatuples))
+        finally:
+            multiple_backend.close()
 
     def inform_moderator(self,
                          content_object,
@@ -185,12 +376,104 @@ class GenericModerator(object):
         from .conf.settings import MODERATORS
 
         if self.notify_moderator:
+            if self.moderator_digest:
+                self.add_to_digest(content_object)
+                return
+
             self.send(
                 content_object=content_object,
                 subject_template=self.subject_template_moderator,
                 message_template=self.message_template_moderator,
                 recipient_list=MODERATORS)
 
+    def add_to_digest(self, content_object):
+        '''
+        Adds the moderated object of content_object to the next digest, sent
+        by the send_moderation_digests command
+        '''
+        from .models import ModeratorDigestEntry
+
+        ModeratorDigestEntry.objects.get_or_create(
+            moderated_object=content_object.moderated_object)
+
+    def digest_is_due(self):
+        '''
+        Whether digest_max_size changes were collected, or the oldest one
+        was collected digest_interval seconds ago
+        '''
+        digest = self._get_digest_queryset().filter(
+            moderated_object__status=MODERATION_STATUS_PENDING).aggregate(
+                size=Count('pk'), oldest=Min('created'))
+        due = timezone.now() - datetime.timedelta(seconds=self.digest_interval)
+        return (digest['size'] >= self.digest_max_size or
+                (digest['oldest'] is not None and digest['oldest'] <= due))
+
+    def send_digest(self, extra_context=None, claim_timeout=600):
+        '''
+        Send the changes collected for the digest that are still pending to
+        moderators
+        '''
+        from .conf.settings import MODERATORS
+        from .models import ModeratorDigestEntry
+
+        # The entries are claimed before sending, so concurrent calls never
+        # send the same change twice, and only deleted once the digest was
+        # sent. Claims older than claim_timeout seconds, left by calls that
+        # died, are taken over.
+        now = timezone.now()
+        stale = now - datetime.timedelta(seconds=claim_timeout)
+        claim = uuid.uuid4().hex
+        self._get_digest_queryset()\
+            .filter(Q(claim='') | Q(claimed__lt=stale))\
+            .update(claim=claim, claimed=now)
+        claimed = ModeratorDigestEntry.objects.filter(claim=claim)
+        claimed.exclude(
+            moderated_object__status=MODERATION_STATUS_PENDING).delete()
+        entries = list(claimed.select_related('moderated_object')
+                              .order_by('created'))
+
+        if not entries or not MODERATORS:
+            claimed.delete()
+            return
+
+        try:
+            context = {
+                'moderated_objects': [entry.moderated_object
+                                      for entry in entries],
+                'site': get_current_site(),
+                'content_type': ContentType.objects.get_for_model(
+                    self.model_class)}
+            if extra_context:
+                context.update(extra_context)
+
+            subject = render_template(self.subject_template_digest, context)
+            message = render_template(self.message_template_digest, context)
+
+            datatuples = tuple({
+                'subject': subject,
+                'message': message,
+                'recipient_list': [moderator],
+            } for moderator in MODERATORS)
+            multiple_backend = self.get_multiple_message_backend()
+            sent = multiple_backend.send(datatuples)
+        except Exception:
+            # Released, so the next call sends the changes again
+            claimed.update(claim='', claimed=None)
+            raise
+
+        # Backends sending right away return the number of sent messages
+        if sent is not None and sent < len(datatuples):
+            claimed.update(claim='', claimed=None)
+        else:
+            claimed.delete()
+
+    def _get_digest_queryset(self):
+        from .models import ModeratorDigestEntry
+
+        return ModeratorDigestEntry.objects.filter(
+            moderated_object__content_type=ContentType.objects.get_for_model(
+                self.model_class))
+
     def inform_user(self, content_object,
                     user,
                     extra_context=None):
@@ -215,8 +498,7 @@ class GenericModerator(object):
         '''
         if self.notify_user:
             self.send_many(
-                queryset=queryset.exclude(changed_by=None)
-                                 .select_related('changed_by__email'),
+                queryset=queryset.exclude(changed_by=None),
                 subject_template=self.subject_template_user,
                 message_template=self.message_template_user,
                 extra_context=extra_context)
@@ -240,6 +522,22 @@ class GenericModerator(object):
 
         return base_manager
 
+    def _get_save_mutated_fields(self):
+        """
+        Returns names of moderated fields that save() itself may change on
+        the instance, such as auto_now dates or file names.
+        """
+        mutated = []
+        for field in self.model_class._meta.fields:
+            if field.name in self.fields_exclude:
+                continue
+            if isinstance(field, DateField) and \
+                    (field.auto_now or field.auto_now_add):
+                mutated.append(field.name)
+            elif isinstance(field, FileField):
+                mutated.append(field.name)
+        return mutated
+
     def _validate_options(self):
         if self.visibility_column:
             try:  # Django 1.10+
@@ -257,3 +555,16 @@ class GenericModerator(object):
                     self.changed_object.__class__,
                     field_type)
                 raise AttributeError(msg)
+
+        if self.state_column:
+            try:  # Django 1.10+
+                field = self.model_class._meta.get_field(self.state_column)
+            except AttributeError:
+                field = self.model_class._meta.get_field_by_name(
+                    self.state_column)[0]
+
+            if not isinstance(field, IntegerField):
+                msg = "state_column field: %s on model %s should "\
+                      "be IntegerField type but is %s"
+                msg %= (self.state_column, self.model_class, type(field))
+                raise AttributeError(msg)
@@ -1,25 +1,99 @@
 from datetime import datetime
 
 from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Prefetch
 from django.db.models.query import QuerySet
+from django.utils import timezone
 
 from . import moderation
 from .constants import (MODERATION_READY_STATE,
                         MODERATION_STATUS_REJECTED,
-                        MODERATION_STATUS_APPROVED)
+                        MODERATION_STATUS_APPROVED,
+                        MODERATION_STATUS_PENDING)
 from .signals import post_many_moderation, pre_many_moderation
+from .utils import django_18
+
+if django_18():
+    from django.db.models import Case, Value, When
 
 
 class ModeratedObjectQuerySet(QuerySet):
-    def approve(self, cls, by, reason=None):
-        self._send_signals_and_moderate(cls, MODERATION_STATUS_APPROVED, by, reason)
+    # Number of changed objects deserialized at once when approving
+    restore_batch_size = 500
+
+    def approve(self, cls=None, by=None, reason=None):
+        self._moderate_by_content_type(cls, MODERATION_STATUS_APPROVED, by,
+                                       reason)
 
-    def reject(self, cls, by, reason=None):
-        self._send_signals_and_moderate(cls, MODERATION_STATUS_REJECTED, by, reason)
+    def reject(self, cls=None, by=None, reason=None):
+        self._moderate_by_content_type(cls, MODERATION_STATUS_REJECTED, by,
+                                       reason)
 
     def moderator(self, cls):
         return moderation.get_moderator(cls)
 
+    def most_recent(self):
+        """
+        Keeps only the most recent ModeratedObject of every object, the one
+        its moderated_object returns
+        """
+        qn = connections[self.db].ops.quote_name
+        opts = self.model._meta
+        columns = dict(
+            table=qn(opts.db_table),
+            pk=qn(opts.pk.column),
+            content_type=qn(opts.get_field('content_type').column),
+            object_pk=qn(opts.get_field('object_pk').column),
+            updated=qn(opts.get_field('updated').column))
+
+        return self.extra(where=[
+            'NOT EXISTS (SELECT 1 FROM {table} newer'
+            ' WHERE newer.{content_type} = {table}.{content_type}'
+            ' AND newer.{object_pk} = {table}.{object_pk}'
+            ' AND (newer.{updated} > {table}.{updated}'
+            ' OR (newer.{updated} = {table}.{updated}'
+            ' AND newer.{pk} > {table}.{pk})))'.format(**columns)])
+
+    def _moderate_by_content_type(self, cls, new_status, by, reason):
+        """
+        Moderates the objects of each content type in the queryset together,
+        or only those of cls if it is given. Moderators with
+        per_object_signals enabled get their objects moderated one by one.
+        """
+        groups = {}
+        for pk, content_type_id in self.values_list('pk', 'content_type'):
+            groups.setdefault(content_type_id, []).append(pk)
+
+        if cls is not None:
+            content_type = ContentType.objects.get_for_model(cls)
+            groups = {content_type.pk: groups.get(content_type.pk, [])}
+
+        for content_type_id, pks in groups.items():
+            if content_type_id is None or not pks:
+                continue
+            model_class = cls
+            if model_class is None:
+                entry = moderation.get_registry_entry(content_type_id)
+                if entry is not None:
+                    model_class = entry.model_class
+                else:
+                    # Not registered, self.moderator() raises below
+                    model_class = ContentType.objects.get_for_id(
+                        content_type_id).model_class()
+
+            # Select by pk, filters on the moderation status would otherwise
+            # stop matching as soon as the objects are updated
+            queryset = self.model.objects.filter(pk__in=pks)
+
+            if self.moderator(model_class).per_object_signals:
+                for moderated_object in queryset:
+                    moderated_object._send_signals_and_moderate(new_status,
+                                                                by, reason)
+            else:
+                queryset._send_signals_and_moderate(model_class, new_status,
+                                                    by, reason)
+
     def _send_signals_and_moderate(self, cls, new_status, by, reason):
         pre_many_moderation.send(sender=cls,
                                  queryset=self,
@@ -37,30 +111,175 @@ class ModeratedObjectQuerySet(QuerySet):
 
     def _moderate(self, cls, new_status, by, reason):
         mod = self.moderator(cls)
-        ct = ContentType.objects.get_for_model(cls)
 
         update_kwargs = {
             'status': new_status,
             'on': datetime.now(),
             'by': by,
             'reason': reason,
+            # auto_now, which update() does not refresh
+            'updated': timezone.now(),
         }
         if new_status == MODERATION_STATUS_APPROVED:
             update_kwargs['state'] = MODERATION_READY_STATE
 
-        self.update(update_kwargs)
+        with transaction.atomic(using=self.db):
+            if (new_status == MODERATION_STATUS_APPROVED and
+                    not mod.visible_until_rejected):
+                # See ModeratedObject._moderate(), approving pending changes
+                # restores them from changed_object to the base objects.
+                self._restore_changed_objects()
+
+            self.update(**update_kwargs)
+
+            if mod.state_column and new_status == MODERATION_STATUS_APPROVED:
+                # After the write back, which restores the old state
+                cls._default_unmoderated_manager.filter(
+                    pk__in=self.values_list('object_pk', flat=True))\
+                   .update(**{mod.state_column: MODERATION_READY_STATE})
+
+            if mod.visibility_column:
+                if new_status == MODERATION_STATUS_APPROVED:
+                    new_visible = True
+                elif new_status == MODERATION_STATUS_REJECTED:
+                    new_visible = False
+                else:  # MODERATION_STATUS_PENDING
+                    new_visible = mod.visible_until_rejected
+
+                cls._default_unmoderated_manager.filter(
+                    pk__in=self.values_list('object_pk', flat=True))\
+                   .update(**{mod.visibility_column: new_visible})
+
+        mod.inform_users(self)
+
+    def _restore_changed_objects(self):
+        """
+        Writes the changed_object of the pending moderated objects back to
+        their base objects, deserializing restore_batch_size of them at a
+        time. Only the newest one is written back for objects with several
+        of them, like approving them one by one would leave it.
+        """
+        field = self.model._meta.get_field('changed_object')
+        values = self.filter(status=MODERATION_STATUS_PENDING)\
+            .order_by('-updated', '-pk')\
+            .values_list('object_pk', 'changed_object')
+
+        batch = []
+        seen = set()
+        for object_pk, value in values.iterator():
+            if object_pk in seen:
+                continue
+            seen.add(object_pk)
+            base_object = field._deserialize(value) if value else None
+            if base_object is not None:
+                batch.append(base_object)
+            if len(batch) >= self.restore_batch_size:
+                save_base_objects(batch, using=self.db)
+                batch = []
+        if batch:
+            save_base_objects(batch, using=self.db)
+
+
+def save_base_objects(objects, using=None):
+    """
+    Saves objects of one model class like obj.save_base(raw=True) would,
+    but with their auto_now fields refreshed and without sending signals,
+    using one UPDATE per table and batch of objects. Objects whose row does
+    not exist anymore are saved one by one.
+    """
+    model = objects[0]._meta.concrete_model
+    # Refresh auto_now fields like Model.save() does
+    auto_now_fields = [f for f in model._meta.concrete_fields
+                       if getattr(f, 'auto_now', False)]
+    for obj in objects:
+        for field in auto_now_fields:
+            field.pre_save(obj, False)
+
+    if not django_18():
+        # Conditional expressions are not available, save them one by one
+        for obj in objects:
+            _save_base(obj, using)
+        return
+
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    # Parent tables first, like Model.save_base()
+    tables = list(reversed(model._meta.get_parent_list())) + [model]
+
+    missing = []
+    for table in tables:
+        table_pk = table._meta.pk
+        fields = [f for f in table._meta.local_concrete_fields
+                  if not f.primary_key]
+        batch_size = connection.ops.bulk_batch_size(
+            [table_pk] + fields * 2, objects)
+
+        for start in range(0, len(objects), batch_size):
+            batch = objects[start:start + batch_size]
+            pks = [getattr(obj, table_pk.attname) for obj in batch]
+            queryset = QuerySet(table, using=using).filter(pk__in=pks)
+
+            if fields:
+                updated = queryset.update(**dict(
+                    (f.name, Case(*[When(pk=pk, then=Value(
+                        getattr(obj, f.attname), output_field=f))
+                        for pk, obj in zip(pks, batch)], output_field=f))
+                    for f in fields))
+            else:
+                updated = queryset.count()
+
+            if table is model and updated < len(batch):
+                existing = set(queryset.values_list('pk', flat=True))
+                missing.extend(obj for pk, obj in zip(pks, batch)
+                               if pk not in existing)
+
+    for obj in missing:
+        _save_base(obj, using)
+
+
+class ModeratedQuerySetMixin(object):
+    """Methods of the querysets of the moderated managers"""
+
+    def with_moderation(self):
+        """
+        Returns the queryset with the most recent ModeratedObject of every
+        object prefetched, so reading their moderated_object takes no more
+        queries.
+        """
+        # We have to import this here to avoid a circular import between
+        # .models and .queryset
+        from .models import ModeratedObject
+
+        return self.prefetch_related(Prefetch(
+            '_relation_object',
+            queryset=ModeratedObject.objects.all().most_recent(),
+            to_attr='_prefetched_moderated_objects'))
+
+
+class ModeratedQuerySet(ModeratedQuerySetMixin, QuerySet):
+    pass
+
+
+# Queryset class of a base manager -> the same with ModeratedQuerySetMixin
+_moderated_queryset_classes = {QuerySet: ModeratedQuerySet}
+
+
+def get_moderated_queryset_class(queryset_class):
+    if issubclass(queryset_class, ModeratedQuerySetMixin):
+        return queryset_class
 
-        if mod.visibility_column:
-            if new_status == MODERATION_STATUS_APPROVED:
-                new_visible = True
-            elif new_status == MODERATION_STATUS_REJECTED:
-                new_visible = False
-            else:  # MODERATION_STATUS_PENDING
-                new_visible = mod.visibile_until_rejected
+    try:
+        return _moderated_queryset_classes[queryset_class]
+    except KeyError:
+        moderated_class = _moderated_queryset_classes[queryset_class] = type(
+            str('Moderated{}'.format(queryset_class.__name__)),
+            (ModeratedQuerySetMixin, queryset_class),
+            {})
+        return moderated_class
 
-            cls.objects.filter(
-                id__in=self.filter(content_type=ct)
-                           .values_list('object_id', flat=True))\
-               .update(**{mod.visibility_column: new_visible})
 
-        mod.inform_users(self.exclude(changed_by=None).select_related('changed_by__email'))
+def _save_base(obj, using):
+    # avoid triggering pre/post_save_handler
+    obj.save_base(raw=True, using=using)
+    # The _save_parents call is required for models with an
+    # inherited visibility_column.
+    obj._save_parents(obj.__class__, using, None)
@@ -1,23 +1,65 @@
 from __future__ import unicode_literals
 
+from collections import namedtuple
+
 try:
     from django.contrib.contenttypes.fields import GenericRelation
 except ImportError:
     from django.contrib.contenttypes.generic import GenericRelation
+from django.contrib.contenttypes.models import ContentType
 from django.utils.six import with_metaclass
 
 from .constants import (MODERATION_DRAFT_STATE,
                         MODERATION_STATUS_APPROVED,
                         MODERATION_STATUS_PENDING)
+from .diff import get_comparison_plan
 from .models import ModeratedObject, STATUS_CHOICES
 from .moderator import GenericModerator
-from .utils import django_110
+from .utils import django_18, django_110
 
 
 class RegistrationError(Exception):
     """Exception thrown when registration with Moderation goes wrong."""
 
 
+# What ModerationManager knows about a registered model, looked up by the
+# id of its content type
+RegistryEntry = namedtuple('RegistryEntry',
+                           'model_class moderator unmoderated_manager')
+
+
+class ModerationSaveContext(object):
+    """
+    State worked out by pre_save_handler for a single save() call, kept on
+    the instance so that post_save_handler can reuse it instead of querying
+    and diffing the same objects again.
+    """
+
+    def __init__(self, moderator):
+        self.moderator = moderator
+        # ModeratedObject matching the database, or None if it must be loaded
+        self.moderated_obj = None
+        # changed_object the diff below was computed against
+        self.compared_object = None
+        self.has_been_changed = None
+
+    def record_diff(self, moderated_obj, has_been_changed):
+        self.compared_object = moderated_obj.changed_object
+        self.has_been_changed = has_been_changed
+
+    def has_object_been_changed(self, moderated_obj, instance):
+        """
+        Returns the diff computed in pre_save_handler if it still applies to
+        moderated_obj and instance, otherwise diffs them again.
+        """
+        if (self.compared_object is not None and
+                moderated_obj.changed_object is self.compared_object and
+                not self.moderator.save_mutated_fields):
+            return self.has_been_changed
+
+        return moderated_obj.has_object_been_changed(instance)
+
+
 class ModerationManagerSingleton(type):
 
     def __init__(cls, name, bases, dict):
@@ -36,9 +78,36 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
     def __init__(self, *args, **kwargs):
         """Initializes the moderation manager."""
         self._registered_models = {}
+        # content_type_id -> RegistryEntry, or None for models that are not
+        # registered. Filled on first lookup, as content types may not be
+        # in the database yet when models are registered.
+        self._registry_index = {}
 
         super(ModerationManager, self).__init__(*args, **kwargs)
 
+    def get_registry_entry(self, content_type_id):
+        """
+        Returns the RegistryEntry of the model with the given content type,
+        or None if that model is not registered with moderation.
+        """
+        try:
+            return self._registry_index[content_type_id]
+        except KeyError:
+            pass
+
+        entry = None
+        if content_type_id is not None:
+            model_class = ContentType.objects.get_for_id(
+                content_type_id).model_class()
+            moderator = self._registered_models.get(model_class)
+            if moderator is not None:
+                entry = RegistryEntry(
+                    model_class, moderator,
+                    model_class._default_unmoderated_manager)
+
+        self._registry_index[content_type_id] = entry
+        return entry
+
     def register(self, model_class, moderator_class=None):
         """Registers model class with moderation"""
         if model_class in self._registered_models:
@@ -64,6 +133,9 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
             raise
         else:
             self._registered_models[model_class] = moderator_class_instance
+            self._registry_index.clear()
+            # Worked out now rather than on the first save
+            get_comparison_plan(model_class)
 
     def _connect_signals(self, model_class):
         from django.db.models import signals
@@ -85,12 +157,16 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
 
         def get_moderated_object(self):
             if not hasattr(self, '_moderated_object'):
-                if self._relation_object.count() > 0:
-                    self._moderated_object = getattr(self, '_relation_object')\
-                        .filter().order_by('-updated')[0]
+                # Filled by with_moderation() of the moderated querysets
+                prefetched = getattr(self, '_prefetched_moderated_objects',
+                                     None)
+                if prefetched is not None:
+                    if not prefetched:
+                        raise ModeratedObject.DoesNotExist
+                    self._moderated_object = prefetched[0]
                 else:
                     self._moderated_object = getattr(self, '_relation_object')\
-                        .get()
+                        .latest('updated')
             return self._moderated_object
 
         model_class.add_to_class('moderated_object',
@@ -195,6 +271,7 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
         except Exception:
             raise
         else:
+            self._registry_index.clear()
             try:
                 self._registered_models.pop(model_class)
             except KeyError:
@@ -252,16 +329,41 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
         if kwargs['raw']:
             return
 
-        unchanged_obj = self._get_unchanged_object(instance)
+        # Drop whatever a previous, unfinished save may have left behind
+        instance.__dict__.pop('_moderation_context', None)
+
+        unchanged_obj, fetched_obj = \
+            self._get_unchanged_and_moderated_objects(instance)
         moderator = self.get_moderator(sender)
         if unchanged_obj:
-            moderated_obj = self._get_or_create_moderated_object(instance,
-                                                                 unchanged_obj,
-                                                                 moderator)
+            context = ModerationSaveContext(moderator)
+            fetched_changed_object = getattr(fetched_obj, 'changed_object',
+                                             None)
+            moderated_obj = self._update_moderated_object(instance,
+                                                          unchanged_obj,
+                                                          fetched_obj,
+                                                          moderator,
+                                                          context)
             if not (moderated_obj.status ==
                     MODERATION_STATUS_APPROVED or
                     moderator.bypass_moderation_after_approval):
                 moderated_obj.save()
+                self._refresh_changed_object(moderated_obj)
+                context.moderated_obj = moderated_obj
+            elif fetched_obj is not None:
+                # Nothing was written, so the ModeratedObject as loaded still
+                # matches the database once it gets back the changed_object
+                # that was diffed, and post_save_handler can use it as is.
+                fetched_obj.changed_object = fetched_changed_object
+                context.moderated_obj = fetched_obj
+            if moderator.state_column:
+                # Otherwise the UPDATE of the instance overwrites the state
+                # that ModeratedObject.save() mirrored to the table
+                state = moderated_obj._mirrored_state
+                if state is None:
+                    state = getattr(unchanged_obj, moderator.state_column)
+                setattr(instance, moderator.state_column, state)
+            instance._moderation_context = context
 
     def _get_unchanged_object(self, instance):
         if instance.pk is None:
@@ -273,6 +375,67 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
         except instance.__class__.DoesNotExist:
             return None
 
+    def _get_unchanged_and_moderated_objects(self, instance):
+        """
+        Returns a tuple of the unchanged object as stored in the database and
+        its most recent ModeratedObject (or None), loaded with one query
+        that joins the model table to ModeratedObject via _relation_object.
+        """
+        if instance.pk is None:
+            return None, None
+
+        if not django_18():
+            # Model.from_db() is not available, fall back to two queries
+            unchanged_obj = self._get_unchanged_object(instance)
+            if unchanged_obj is None:
+                return None, None
+            try:
+                moderated_obj = ModeratedObject.objects.get_for_instance(
+                    instance)
+            except ModeratedObject.DoesNotExist:
+                moderated_obj = None
+            return unchanged_obj, moderated_obj
+
+        model_class = instance.__class__
+        manager = model_class._default_unmoderated_manager
+        model_fields = model_class._meta.concrete_fields
+        mobj_fields = ModeratedObject._meta.concrete_fields
+
+        lookups = [f.attname for f in model_fields] + \
+            ['_relation_object__%s' % f.name for f in mobj_fields]
+        rows = list(manager.filter(pk=instance.pk)
+                           .order_by('-_relation_object__updated')
+                           .values_list(*lookups)[:1])
+        if not rows:
+            return None, None
+
+        row = rows[0]
+        split = len(model_fields)
+        unchanged_obj = model_class.from_db(
+            manager.db, [f.attname for f in model_fields], row[:split])
+
+        mobj_values = row[split:]
+        if mobj_values[0] is None:
+            # LEFT OUTER JOIN found no ModeratedObject for this row
+            return unchanged_obj, None
+
+        moderated_obj = ModeratedObject.from_db(
+            manager.db, [f.attname for f in mobj_fields], mobj_values)
+        return unchanged_obj, moderated_obj
+
+    def _refresh_changed_object(self, moderated_obj):
+        """
+        Resets changed_object to the text that was just written, as a fresh
+        database load would, so a ModeratedObject saved in pre_save_handler
+        can be reused in post_save_handler instead of being fetched again.
+        """
+        field = moderated_obj._meta.get_field('changed_object')
+        # Deserialized again on first access
+        moderated_obj.changed_object = field.pre_save(moderated_obj, False)
+        # A reloaded ModeratedObject would not carry the content_object it
+        # was created with, which save() would otherwise write back.
+        moderated_obj.instance = None
+
     def _get_updated_object(self, instance, unchanged_obj, moderator):
         """
         Returns the unchanged object with the excluded fields updated to
@@ -286,50 +449,43 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
 
         return unchanged_obj
 
-    def _get_or_create_moderated_object(self, instance,
-                                        unchanged_obj, moderator):
+    def _update_moderated_object(self, instance, unchanged_obj,
+                                 moderated_object, moderator, context=None):
         """
-        Get or create ModeratedObject instance.
-        If moderated object is not equal instance then serialize unchanged
-        in moderated object in order to use it later in post_save_handler
+        Returns moderated_object updated with changes from instance, or a new
+        ModeratedObject if there is none yet or keep_history requires one.
+        The diff against an existing moderated_object is recorded in context.
         """
         def get_new_instance(unchanged_obj):
             moderated_object = ModeratedObject(content_object=unchanged_obj)
             moderated_object.changed_object = unchanged_obj
             return moderated_object
 
-        try:
-            # if moderator.keep_history:
-            #     moderated_object = get_new_instance(unchanged_obj)
-            # else:
-            #     moderated_object = ModeratedObject.objects.\
-            #         get_for_instance(instance)
-
-            moderated_object = ModeratedObject.objects.get_for_instance(
-                instance)
-            if moderated_object is None:
-                moderated_object = get_new_instance(unchanged_obj)
-            elif moderator.keep_history and \
-                    moderated_object.has_object_been_changed(
-                    instance):
-                # We're keeping history and this isn't an update of an existing
-                # moderation
-                moderated_object = get_new_instance(unchanged_obj)
-
-        except ModeratedObject.DoesNotExist:
+        if moderated_object is None:
+            return get_new_instance(unchanged_obj)
+
+        excludes = set(moderator.fields_exclude)
+        changed_fields = moderated_object._get_changed_fields(instance)
+        has_been_changed = bool(changed_fields - excludes)
+        if context is not None:
+            context.record_diff(moderated_object, has_been_changed)
+
+        if moderator.keep_history and has_been_changed:
+            # We're keeping history and this isn't an update of an existing
+            # moderation
             moderated_object = get_new_instance(unchanged_obj)
+            changed_fields = moderated_object._get_changed_fields(instance)
+            has_been_changed = bool(changed_fields - excludes)
 
-        else:
-            if moderated_object.has_object_been_changed(instance):
-                if moderator.visible_until_rejected:
-                    moderated_object.changed_object = instance
-                else:
-                    moderated_object.changed_object = self._get_updated_object(
-                        instance, unchanged_obj, moderator)
-            elif moderated_object.has_object_been_changed(instance,
-                                                          only_excluded=True):
+        if has_been_changed:
+            if moderator.visible_until_rejected:
+                moderated_object.changed_object = instance
+            else:
                 moderated_object.changed_object = self._get_updated_object(
                     instance, unchanged_obj, moderator)
+        elif changed_fields & excludes:
+            moderated_object.changed_object = self._get_updated_object(
+                instance, unchanged_obj, moderator)
 
         return moderated_object
 
@@ -342,6 +498,10 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
 
         return moderator_instance
 
+    def get_moderators(self):
+        """Returns the moderators of all registered models"""
+        return list(self._registered_models.values())
+
     def post_save_handler(self, sender, instance, **kwargs):
         """
         Creates new moderation object if instance is created,
@@ -363,10 +523,17 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
                 # Hide it by placing in draft state
                 moderated_obj.state = MODERATION_DRAFT_STATE
             moderated_obj.save()
+            if moderator.state_column:
+                # Mirrored to the table by save(), keep the instance in sync
+                setattr(instance, moderator.state_column,
+                        moderated_obj._mirrored_state)
             moderator.inform_moderator(instance)
             return
 
-        moderated_obj = ModeratedObject.objects.get_for_instance(instance)
+        context = instance.__dict__.pop('_moderation_context', None)
+        moderated_obj = context.moderated_obj if context else None
+        if moderated_obj is None:
+            moderated_obj = ModeratedObject.objects.get_for_instance(instance)
 
         if (moderated_obj.status == MODERATION_STATUS_APPROVED and
                 moderator.bypass_moderation_after_approval):
@@ -375,7 +542,13 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
             moderated_obj.save()
             return
 
-        if moderated_obj.has_object_been_changed(instance):
+        if context:
+            has_been_changed = context.has_object_been_changed(moderated_obj,
+                                                               instance)
+        else:
+            has_been_changed = moderated_obj.has_object_been_changed(instance)
+
+        if has_been_changed:
             copied_instance = self._copy_model_instance(instance)
 
             if not moderator.visible_until_rejected:
@@ -389,10 +562,12 @@ class ModerationManager(with_metaclass(ModerationManagerSingleton, object)):
 
             moderated_obj.status = MODERATION_STATUS_PENDING
             moderated_obj.save()
-            moderator.inform_moderator(instance)
+            # Set before informing the moderator, whose message uses it
             instance._moderated_object = moderated_obj
+            moderator.inform_moderator(instance)
 
     def _copy_model_instance(self, obj):
+        # By attname, so foreign keys are copied without loading the objects
         initial = dict(
-            [(f.name, getattr(obj, f.name)) for f in obj._meta.fields])
+            [(f.attname, getattr(obj, f.attname)) for f in obj._meta.fields])
         return obj.__class__(**initial)
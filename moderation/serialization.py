@@ -0,0 +1,164 @@
+"""
+Fast path for SerializedObjectField's json format.
+
+Writes and reads the same documents as Django's json serializer, but from
+field lists worked out once per model class, without going through the
+generic django.core.serializers machinery. Anything the fast path does not
+handle makes it give up, and the field falls back to Django's serializer.
+"""
+from __future__ import unicode_literals
+
+import json
+from collections import OrderedDict
+
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import is_protected_type
+
+from .utils import django_18
+
+
+class Unsupported(Exception):
+    """Raised when a document has to go through Django's serializer"""
+
+
+class SerializationPlan(object):
+    """
+    Fields of a model class as Django's json serializer sees them, with the
+    callables needed to convert their values.
+    """
+
+    def __init__(self, model_class):
+        opts = model_class._meta
+        concrete_opts = opts.concrete_model._meta
+
+        self.model_class = model_class
+        self.label = str(opts)
+        self.pk = opts.pk
+        self.dump_fields = [f for f in concrete_opts.local_fields
+                            if f.serialize]
+        # Many to many values would need a query per field to serialize
+        self.can_dump = not any(f.serialize
+                                for f in concrete_opts.many_to_many)
+
+        self.concrete_fields = opts.concrete_fields
+        self.pk_index = self.concrete_fields.index(self.pk)
+        self.converters = dict((f.name, (f.attname, self._get_converter(f)))
+                               for f in self.concrete_fields)
+        # Values of fields removed from the model since the document was
+        # written, and of many to many fields, are not restored
+        self.field_names = set(f.name for f in opts.get_fields())
+        self.m2m_names = set(f.name for f in opts.many_to_many)
+        # Django's serializer looks up instances without a primary key by
+        # natural key
+        self.has_natural_key = (
+            hasattr(model_class, 'natural_key') and
+            hasattr(model_class._default_manager, 'get_by_natural_key'))
+
+    def _get_converter(self, field):
+        if not (field.many_to_one or field.one_to_one):
+            return field.to_python
+
+        target_field = field.foreign_related_fields[0]
+
+        def to_python(value):
+            if value is None:
+                return None
+            return target_field.to_python(value)
+        return to_python
+
+    def dump(self, obj):
+        fields = OrderedDict()
+        for field in self.dump_fields:
+            value = field.value_from_object(obj)
+            if not is_protected_type(value):
+                value = field.value_to_string(obj)
+            fields[field.name] = value
+
+        pk = self.pk.value_from_object(obj)
+        if not is_protected_type(pk):
+            pk = self.pk.value_to_string(obj)
+
+        return OrderedDict([('model', self.label),
+                            ('pk', pk),
+                            ('fields', fields)])
+
+    def load(self, data):
+        values = {}
+        if 'pk' in data:
+            values[self.pk.attname] = self.pk.to_python(data['pk'])
+
+        for name, value in data['fields'].items():
+            try:
+                attname, to_python = self.converters[name]
+            except KeyError:
+                if name in self.m2m_names or name not in self.field_names:
+                    continue
+                raise Unsupported(name)
+            if isinstance(value, list):
+                # Natural foreign key
+                raise Unsupported(name)
+            values[attname] = to_python(value)
+
+        args = []
+        for field in self.concrete_fields:
+            try:
+                args.append(values[field.attname])
+            except KeyError:
+                args.append(field.get_default())
+
+        if args[self.pk_index] is None and self.has_natural_key:
+            raise Unsupported(self.pk.name)
+
+        return self.model_class(*args)
+
+
+_plans = {}
+
+
+def get_serialization_plan(model_class):
+    if not django_18():
+        # Plans are built from the field API introduced in Django 1.8
+        raise Unsupported(model_class)
+
+    try:
+        return _plans[model_class]
+    except KeyError:
+        plan = _plans[model_class] = SerializationPlan(model_class)
+        return plan
+
+
+def dumps(objects):
+    """Returns objects in Django's json format"""
+    dump_objects = []
+    for obj in objects:
+        plan = get_serialization_plan(obj.__class__)
+        if not plan.can_dump:
+            raise Unsupported(plan.label)
+        dump_objects.append(plan.dump(obj))
+
+    return json.dumps(dump_objects, cls=DjangoJSONEncoder)
+
+
+def loads(value):
+    """
+    Returns the instance stored in a json document holding one object.
+    Documents with parent entries of multi-table inheritance are left to
+    Django's serializer, as restoring those may query related objects.
+    """
+    objects = json.loads(value)
+    if len(objects) != 1:
+        raise Unsupported(len(objects))
+
+    data = objects[0]
+    try:
+        model_class = apps.get_model(data['model'])
+    except LookupError:
+        raise Unsupported(data['model'])
+
+    try:
+        return get_serialization_plan(model_class).load(data)
+    except (TypeError, ValueError, LookupError, ValidationError):
+        # Let Django's serializer raise its own errors
+        raise Unsupported(data['model'])
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tests', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModelWithStateField',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('test', models.CharField(max_length=20)),
+                ('moderation_state', models.SmallIntegerField(default=0, db_index=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
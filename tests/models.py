@@ -88,6 +88,17 @@ class ModelWithVisibilityField(models.Model):
         return '%s - is public %s' % (self.test, self.is_public)
 
 
+class ModelWithStateField(models.Model):
+    test = models.CharField(max_length=20)
+    moderation_state = models.SmallIntegerField(default=0, db_index=True)
+
+    def __unicode__(self):
+        return '%s - state %s' % (self.test, self.moderation_state)
+
+    def __str__(self):
+        return '%s - state %s' % (self.test, self.moderation_state)
+
+
 class ModelWithWrongVisibilityField(models.Model):
     test = models.CharField(max_length=20)
     is_public = models.IntegerField()
@@ -116,6 +116,21 @@ class AdminActionsTestCase(TestCase):
         for obj in ModeratedObject.objects.all():
             self.assertEqual(obj.status, MODERATION_STATUS_APPROVED)
 
+    def test_approve_objects_keep_history(self):
+        self.moderation.get_moderator(User).keep_history = True
+        for first_name in ('First', 'Second'):
+            user = User.unmoderated_objects.get(username='user1')
+            user.first_name = first_name
+            user.save()
+
+        approve_objects(self.admin, self.request,
+                        ModeratedObject.objects.filter(
+                            status=MODERATION_STATUS_PENDING))
+
+        self.assertEqual(
+            User.unmoderated_objects.get(username='user1').first_name,
+            'Second')
+
     def test_reject_objects(self):
         qs = ModeratedObject.objects.all()
 
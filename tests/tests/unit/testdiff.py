@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import unittest
+
+import mock
+
 from moderation.diff import get_changes_between_models, html_to_list,\
-    TextChange, get_diff_operations, ImageChange
+    TextChange, get_diff_operations, get_opcodes, get_line_opcodes,\
+    ImageChange, get_diff_cache_key, render_diff_operations,\
+    get_comparison_plan, iter_changed_fields
+from django.core.cache import cache
 from django.test.testcases import TestCase
 from django.contrib.auth.models import User
 from django.db.models import fields
+from django.utils.safestring import SafeData
 from tests.models import UserProfile, \
     ModelWithDateField, ModelWithImage
 from moderation.models import ModeratedObject
@@ -51,6 +58,94 @@ class TextChangeObjectTestCase(unittest.TestCase):
             '</del><ins class="diff modified">test2</ins>\n')
 
 
+class DiffCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def _change(self):
+        return TextChange(verbose_name='description',
+                          field=fields.CharField,
+                          change=('test1', 'test2'),
+                          cache_key='moderation-diff:1:description')
+
+    def test_diff_is_cached(self):
+        diff = self._change().diff
+
+        with mock.patch('moderation.diff.get_diff_operations') as get:
+            self.assertEqual(self._change().diff, diff)
+        self.assertFalse(get.called)
+
+    def test_long_diff_is_not_cached(self):
+        with mock.patch('moderation.conf.settings.DIFF_CACHE_MAX_SIZE', 10):
+            self._change().diff
+
+        self.assertEqual(cache.get('moderation-diff:1:description'), None)
+
+    def test_change_without_cache_key_is_not_cached(self):
+        change = self._change()
+        change.cache_key = None
+        change.diff
+
+        self.assertEqual(cache.get('moderation-diff:1:description'), None)
+
+
+class RenderDiffOperationsTestCase(unittest.TestCase):
+
+    def test_same_html_as_template(self):
+        change = TextChange(verbose_name='description',
+                            field=fields.CharField,
+                            change=('Tom & <b>Jerry</b> run',
+                                    'Tom & "Spike" run fast'))
+        diff_operations = get_diff_operations(*change.change)
+
+        self.assertEqual(
+            render_diff_operations(diff_operations),
+            change.render_diff('moderation/html_diff.html',
+                               {'diff_operations': diff_operations}))
+
+    def test_whitespace_between_changes_is_kept(self):
+        self.assertEqual(
+            render_diff_operations(get_diff_operations('a b', 'c d')),
+            '<del class="diff modified">a</del>'
+            '<ins class="diff modified">c</ins><span> </span>'
+            '<del class="diff modified">b</del>'
+            '<ins class="diff modified">d</ins>\n')
+
+    def test_unchanged_text_is_escaped(self):
+        change = TextChange(verbose_name='description',
+                            field=fields.CharField,
+                            change=('<b>test</b>', '<b>test</b>'))
+
+        self.assertEqual(change.diff, '&lt;b&gt;test&lt;/b&gt;')
+
+    def test_diff_is_safe(self):
+        for change in (('<b>test</b>', '<b>test</b>'), ('test1', 'test2')):
+            diff = TextChange(verbose_name='description',
+                              field=fields.CharField,
+                              change=change).diff
+            self.assertIsInstance(diff, SafeData)
+
+    def test_diff_template(self):
+        change = TextChange(verbose_name='description',
+                            field=fields.CharField,
+                            change=('test1', 'test2'))
+
+        with mock.patch('moderation.conf.settings.DIFF_TEMPLATE',
+                        'moderation/html_diff.html'), \
+                mock.patch('moderation.diff.render_diff_operations') \
+                as render:
+            diff = change.diff
+
+        self.assertFalse(render.called)
+        self.assertEqual(diff,
+                         '<del class="diff modified">test1'
+                         '</del><ins class="diff modified">test2</ins>\n')
+
+
 class ImageChangeObjectTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -107,6 +202,89 @@ class DiffModeratedObjectTestCase(TestCase):
             "'userprofile__url': Change object: http://www.google.com - "
             "http://www.google.com", str(changes))
 
+    def test_comparison_plan(self):
+        plan = get_comparison_plan(UserProfile)
+
+        self.assertIs(get_comparison_plan(UserProfile), plan)
+        self.assertEqual([field_plan.key for field_plan in plan],
+                         ['userprofile__user', 'userprofile__description',
+                          'userprofile__url'])
+        self.assertEqual([field_plan.is_foreign_object
+                          for field_plan in plan], [True, False, False])
+
+        status_plan = [field_plan
+                       for field_plan in get_comparison_plan(ModeratedObject)
+                       if field_plan.name == 'status'][0]
+        self.assertEqual(status_plan.display_method, 'get_status_display')
+
+    def test_iter_changed_fields(self):
+        changed_profile = UserProfile.objects.get(pk=self.profile.pk)
+        changed_profile.description = 'New description'
+        changed_profile.url = 'http://www.example.com'
+
+        self.assertEqual(
+            set(iter_changed_fields(self.profile, changed_profile)),
+            set(['description', 'url']))
+        self.assertEqual(
+            list(iter_changed_fields(self.profile, changed_profile,
+                                     excludes=['url'])),
+            ['description'])
+        self.assertEqual(
+            list(iter_changed_fields(self.profile, changed_profile,
+                                     includes=['user'])),
+            [])
+
+    def test_get_changes_between_models_cache_key(self):
+        self.profile.description = 'New description'
+        moderated_object = ModeratedObject(content_object=self.profile)
+        moderated_object.save()
+        cache_key = get_diff_cache_key(moderated_object)
+
+        changes = get_changes_between_models(moderated_object.changed_object,
+                                             self.profile,
+                                             cache_key=cache_key)
+
+        self.assertEqual(changes['userprofile__description'].cache_key,
+                         cache_key + ':userprofile__description')
+
+        moderated_object.save()
+        self.assertNotEqual(get_diff_cache_key(moderated_object), cache_key)
+
+    def test_cache_key_changes_with_base_object(self):
+        self.profile.description = 'New description'
+        moderated_object = ModeratedObject(content_object=self.profile)
+        moderated_object.save()
+        base_object = UserProfile.objects.get(pk=self.profile.pk)
+        cache_key = get_diff_cache_key(moderated_object, base_object)
+
+        self.assertEqual(get_diff_cache_key(moderated_object, base_object),
+                         cache_key)
+        self.assertTrue(cache_key.startswith(
+            get_diff_cache_key(moderated_object)))
+
+        base_object.url = 'http://www.example.com'
+        self.assertNotEqual(
+            get_diff_cache_key(moderated_object, base_object), cache_key)
+
+    def test_cache_key_changes_with_options(self):
+        moderated_object = ModeratedObject(content_object=self.profile)
+        moderated_object.save()
+        cache_key = get_diff_cache_key(moderated_object)
+
+        self.assertNotEqual(
+            get_diff_cache_key(moderated_object, excludes=['description']),
+            cache_key)
+        self.assertNotEqual(
+            get_diff_cache_key(moderated_object, resolve_foreignkeys=True),
+            cache_key)
+        with mock.patch('moderation.conf.settings.DIFF_TEMPLATE',
+                        'moderation/html_diff.html'):
+            self.assertNotEqual(get_diff_cache_key(moderated_object),
+                                cache_key)
+        with mock.patch('moderation.diff.DIFF_CACHE_VERSION', 0):
+            self.assertNotEqual(get_diff_cache_key(moderated_object),
+                                cache_key)
+
     def test_foreign_key_changes(self):
         self.profile.user = User.objects.get(username='admin')
         moderated_object = ModeratedObject(content_object=self.profile)
@@ -146,6 +324,24 @@ class DiffModeratedObjectTestCase(TestCase):
         self.assertIn("'userprofile__url': Change object: http://www"
                       ".google.com - http://www.google.com", str(changes))
 
+    def test_resolved_foreign_keys_are_not_cached(self):
+        self.profile.user = User.objects.get(username='admin')
+        moderated_object = ModeratedObject(content_object=self.profile)
+        moderated_object.save()
+        cache_key = get_diff_cache_key(moderated_object)
+
+        self.profile = UserProfile.objects.get(user__username='moderator')
+
+        changes = get_changes_between_models(moderated_object.changed_object,
+                                             self.profile,
+                                             resolve_foreignkeys=True,
+                                             cache_key=cache_key)
+
+        # Renaming the related objects changes the resolved values
+        self.assertIsNone(changes['userprofile__user'].cache_key)
+        self.assertEqual(changes['userprofile__description'].cache_key,
+                         cache_key + ':userprofile__description')
+
     def test_get_changes_between_models_image(self):
         '''Verify proper diff for ImageField fields'''
 
@@ -222,6 +418,87 @@ class DiffTestCase(unittest.TestCase):
                                               ])
 
 
+class DiffOperationsTestCase(unittest.TestCase):
+
+    def test_get_diff_operations(self):
+        self.assertEqual(
+            get_diff_operations('The quick brown fox jumps',
+                                'The quick red fox jumps high'),
+            [{'operation': 'equal', 'deleted': 'The quick ',
+              'inserted': 'The quick '},
+             {'operation': 'replace', 'deleted': 'brown',
+              'inserted': 'red'},
+             {'operation': 'equal', 'deleted': ' fox jumps',
+              'inserted': ' fox jumps'},
+             {'operation': 'insert', 'deleted': '',
+              'inserted': ' high'}])
+
+    def test_get_opcodes_is_shortest(self):
+        self.assertEqual(get_opcodes('abcabba', 'cbabac', 100, 100),
+                         [('delete', 0, 2, 0, 0),
+                          ('equal', 2, 3, 0, 1),
+                          ('insert', 3, 3, 1, 2),
+                          ('equal', 3, 5, 2, 4),
+                          ('delete', 5, 6, 4, 4),
+                          ('equal', 6, 7, 4, 5),
+                          ('insert', 7, 7, 5, 6)])
+
+    def test_get_opcodes_gives_up(self):
+        self.assertEqual(get_opcodes('abcd', 'abxyd', 1, 100), None)
+        self.assertEqual(get_opcodes('abcd', 'abxyd', 100, 2), None)
+        self.assertEqual(get_opcodes('abcd', 'abxyd', 3, 3),
+                         [('equal', 0, 2, 0, 2),
+                          ('replace', 2, 3, 2, 4),
+                          ('equal', 3, 4, 4, 5)])
+
+    def test_falls_back_to_lines(self):
+        a = 'first line\nsecond line\nthird line\n'
+        b = 'first line\nsecond row of text\nthird line\n'
+
+        with mock.patch('moderation.conf.settings.DIFF_MAX_TOKENS', 2):
+            operations = get_diff_operations(a, b)
+
+        self.assertEqual(
+            [(operation['operation'], operation['deleted'],
+              operation['inserted']) for operation in operations],
+            [('equal', 'first line\n', 'first line\n'),
+             ('replace', 'second line\n', 'second row of text\n'),
+             ('equal', 'third line\n', 'third line\n')])
+
+    def test_heavily_edited_text_is_diffed_line_by_line(self):
+        a_lines = ['line %s\n' % i for i in range(300)]
+        b_lines = [line.upper() if i % 3 == 0 else line
+                   for i, line in enumerate(a_lines)]
+        a, b = ''.join(a_lines), ''.join(b_lines)
+
+        with mock.patch('moderation.conf.settings.DIFF_MAX_TOKENS', 10), \
+                mock.patch('moderation.conf.settings.DIFF_MAX_EDITS', 10):
+            operations = get_diff_operations(a, b)
+
+        self.assertEqual(len(operations), 200)
+        self.assertEqual(operations[0], {'operation': 'replace',
+                                         'deleted': 'line 0\n',
+                                         'inserted': 'LINE 0\n'})
+        self.assertEqual(''.join(o['deleted'] for o in operations), a)
+        self.assertEqual(''.join(o['inserted'] for o in operations), b)
+
+    def test_get_line_opcodes_with_repeated_lines(self):
+        a = ['x\n', 'a\n', 'x\n', 'b\n', 'x\n', 'c\n']
+        b = ['x\n', 'a\n', 'y\n', 'x\n', 'c\n', 'x\n']
+
+        opcodes = get_line_opcodes(a, b, 100)
+
+        self.assertEqual(opcodes, get_opcodes(a, b, 100, 100))
+
+    def test_falls_back_to_replacing_everything(self):
+        with mock.patch('moderation.conf.settings.DIFF_MAX_EDITS', 0):
+            operations = get_diff_operations('one\ntwo', 'three\nfour')
+
+        self.assertEqual(operations, [{'operation': 'replace',
+                                       'deleted': 'one\ntwo',
+                                       'inserted': 'three\nfour'}])
+
+
 class DateFieldTestCase(TestCase):
     fixtures = ['test_users.json']
 
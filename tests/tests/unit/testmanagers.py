@@ -1,4 +1,8 @@
 from __future__ import unicode_literals
+from unittest import skipUnless
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
 from django.test.testcases import TestCase
 from django.contrib.auth.models import User
 from tests.models import UserProfile, \
@@ -149,3 +153,60 @@ class ModeratedObjectManagerTestCase(TestCase):
         moderated_object_pk1 = ModeratedObject.objects.get(pk=1)
         self.assertEqual('http://www.yahoo.com',
                          moderated_object_pk1.changed_object.url)
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'),
+            'Query plans are only checked on SQLite and PostgreSQL')
+class ModeratedObjectIndexesTestCase(TestCase):
+    fixtures = ['test_users.json', 'test_moderation.json']
+
+    def setUp(self):
+        self.moderation = setup_moderation([UserProfile])
+        self.profile = UserProfile.objects.get(user__username='moderator')
+
+    def tearDown(self):
+        teardown_moderation()
+
+    def get_index_name(self, columns):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, ModeratedObject._meta.db_table)
+        for name, constraint in constraints.items():
+            if constraint['index'] and constraint['columns'] == columns:
+                return name
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            else:
+                # The test tables are too small for the planner to prefer an
+                # index otherwise
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql, params)
+            return ' '.join(str(value) for row in cursor.fetchall()
+                            for value in row)
+
+    def assertUsesIndex(self, queryset, columns):
+        index_name = self.get_index_name(columns)
+        self.assertTrue(index_name)
+        self.assertIn(index_name, self.explain(queryset))
+
+    def test_get_for_instance_query(self):
+        queryset = ModeratedObject.objects.filter(
+            object_pk=self.profile.pk,
+            content_type=ContentType.objects.get_for_model(UserProfile))\
+            .order_by('-updated')
+
+        self.assertUsesIndex(queryset,
+                             ['content_type_id', 'object_pk', 'updated'])
+
+    def test_moderated_objects_query(self):
+        self.assertUsesIndex(UserProfile.objects.all(),
+                             ['content_type_id', 'object_pk', 'state'])
+
+    def test_changelist_query(self):
+        queryset = ModeratedObject.objects.all()
+
+        self.assertUsesIndex(queryset, ['status', 'created'])
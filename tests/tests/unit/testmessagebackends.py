@@ -0,0 +1,379 @@
+from __future__ import unicode_literals
+
+import datetime
+import threading
+from smtplib import SMTPException, SMTPServerDisconnected
+from unittest import skipIf
+
+import mock
+
+from django.contrib.auth.models import User
+from django.core import mail, management
+from django.core.mail import EmailMessage, get_connection
+from django.test.testcases import TestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from moderation.message_backends import (ConnectionPool,
+                                         PooledEmailMessageBackend,
+                                         PooledEmailMultipleMessageBackend,
+                                         QueuedEmailMessageBackend,
+                                         QueuedEmailMultipleMessageBackend,
+                                         ThreadedEmailMessageBackend,
+                                         ThreadedEmailMultipleMessageBackend,
+                                         ThreadPoolDelivery,
+                                         ThreadPoolExecutor,
+                                         send_queued_messages)
+from moderation.models import ModeratedObject, QueuedMessage
+from moderation.moderator import GenericModerator
+from tests.models import UserProfile
+from tests.utils import setup_moderation, teardown_moderation
+
+
+class QueuedMessageBackendTestCase(TestCase):
+    fixtures = ['test_users.json', 'test_moderation.json']
+
+    def setUp(self):
+        class UserProfileModerator(GenericModerator):
+            message_backend_class = QueuedEmailMessageBackend
+            multiple_message_backend_class = \
+                QueuedEmailMultipleMessageBackend
+
+        self.moderation = setup_moderation([(UserProfile,
+                                             UserProfileModerator)])
+        self.user = User.objects.get(username='moderator')
+
+    def tearDown(self):
+        teardown_moderation()
+
+    def _queue(self, count=1):
+        QueuedEmailMultipleMessageBackend().send([
+            {'subject': 'Subject %s' % i,
+             'message': 'Message %s' % i,
+             'recipient_list': ['user%s@example.com' % i]}
+            for i in range(count)])
+
+    def test_save_queues_moderator_notification(self):
+        profile = UserProfile(description='Profile for new user',
+                              url='http://www.test.com',
+                              user=User.objects.get(username='user1'))
+        profile.save()
+
+        self.assertEqual(len(mail.outbox), 0)
+        queued_message = QueuedMessage.objects.get()
+        self.assertEqual(queued_message.recipient_list, ['test@example.com'])
+
+    def test_bulk_approve_queues_user_notifications(self):
+        profile = UserProfile.objects.get(user__username='moderator')
+        ModeratedObject(content_object=profile, changed_by=self.user).save()
+
+        ModeratedObject.objects.all().approve(by=self.user)
+
+        self.assertEqual(len(mail.outbox), 0)
+        queued_message = QueuedMessage.objects.get()
+        self.assertEqual(queued_message.recipient_list, [self.user.email])
+
+    def test_send_queued_messages(self):
+        self._queue(3)
+
+        self.assertEqual(send_queued_messages(batch_size=2), (2, 0))
+        self.assertEqual([message.subject for message in mail.outbox],
+                         ['Subject 0', 'Subject 1'])
+        self.assertEqual(mail.outbox[0].to, ['user0@example.com'])
+
+        self.assertEqual(send_queued_messages(batch_size=2), (1, 0))
+        self.assertEqual(send_queued_messages(batch_size=2), (0, 0))
+        self.assertFalse(QueuedMessage.objects.exists())
+
+    def test_failed_messages_are_retried(self):
+        self._queue()
+
+        with mock.patch('django.core.mail.EmailMessage.send',
+                        side_effect=SMTPException('Connection refused')):
+            self.assertEqual(
+                send_queued_messages(max_attempts=2, retry_delay=0), (0, 1))
+            self.assertEqual(
+                send_queued_messages(max_attempts=2, retry_delay=0), (0, 1))
+            # Given up on
+            self.assertEqual(
+                send_queued_messages(max_attempts=2, retry_delay=0), (0, 0))
+
+        queued_message = QueuedMessage.objects.get()
+        self.assertEqual(queued_message.attempts, 2)
+        self.assertEqual(queued_message.last_error,
+                         'SMTPException: Connection refused')
+
+    def test_failed_messages_are_retried_after_delay(self):
+        self._queue()
+
+        with mock.patch('django.core.mail.EmailMessage.send',
+                        side_effect=SMTPException('Connection refused')):
+            self.assertEqual(send_queued_messages(retry_delay=60), (0, 1))
+            # Not due yet
+            self.assertEqual(send_queued_messages(retry_delay=60), (0, 0))
+
+            queued_message = QueuedMessage.objects.get()
+            QueuedMessage.objects.update(
+                next_attempt=queued_message.next_attempt -
+                datetime.timedelta(seconds=60))
+            self.assertEqual(send_queued_messages(retry_delay=60), (0, 1))
+
+        # Doubled with every failed attempt
+        queued_message = QueuedMessage.objects.get()
+        delay = queued_message.next_attempt - timezone.now()
+        self.assertTrue(datetime.timedelta(seconds=100) < delay <=
+                        datetime.timedelta(seconds=120))
+
+        self.assertEqual(send_queued_messages(retry_delay=60), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_claimed_messages_are_skipped(self):
+        self._queue(2)
+        claimed = QueuedMessage.objects.order_by('created')[0]
+        QueuedMessage.objects.filter(pk=claimed.pk).update(
+            claim='other', claimed=timezone.now())
+
+        self.assertEqual(send_queued_messages(), (1, 0))
+        self.assertEqual(list(QueuedMessage.objects.all()), [claimed])
+
+    def test_stale_claims_are_taken_over(self):
+        self._queue()
+        QueuedMessage.objects.update(
+            claim='other',
+            claimed=timezone.now() - datetime.timedelta(seconds=601))
+
+        self.assertEqual(send_queued_messages(claim_timeout=600), (1, 0))
+        self.assertFalse(QueuedMessage.objects.exists())
+
+    def test_send_moderation_messages_command(self):
+        self._queue(3)
+        out = StringIO()
+
+        management.call_command('send_moderation_messages', batch_size=2,
+                                stdout=out)
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(QueuedMessage.objects.exists())
+        self.assertEqual(out.getvalue().strip(), 'Sent 3 messages, 0 failed')
+
+
+@skipIf(ThreadPoolExecutor is None, 'The futures package is not installed')
+class ThreadedMessageBackendTestCase(TestCase):
+
+    def setUp(self):
+        self.delivery = ThreadPoolDelivery(max_workers=2, max_queued=1)
+
+    def tearDown(self):
+        self.delivery.shutdown()
+
+    def _send(self, backend_class, *args, **kwargs):
+        with mock.patch('moderation.message_backends.'
+                        'get_thread_pool_delivery',
+                        return_value=self.delivery):
+            backend_class().send(*args, **kwargs)
+
+    def test_send(self):
+        self._send(ThreadedEmailMessageBackend, subject='Subject',
+                   message='Message', recipient_list=['user@example.com'])
+        self.delivery.flush()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['user@example.com'])
+        self.assertEqual((self.delivery.queued, self.delivery.sent,
+                          self.delivery.failed, self.delivery.pending),
+                         (1, 1, 0, 0))
+
+    def test_send_many(self):
+        self._send(ThreadedEmailMultipleMessageBackend, [
+            {'subject': 'Subject %s' % i,
+             'message': 'Message %s' % i,
+             'recipient_list': ['user%s@example.com' % i]}
+            for i in range(3)])
+        self.delivery.flush()
+
+        self.assertEqual(sorted(message.subject for message in mail.outbox),
+                         ['Subject 0', 'Subject 1', 'Subject 2'])
+        self.assertEqual(self.delivery.sent, 3)
+
+    def test_failed_messages_are_counted(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages',
+                        side_effect=SMTPException('Connection refused')), \
+                mock.patch('moderation.message_backends.logger') as logger:
+            self._send(ThreadedEmailMessageBackend, subject='Subject',
+                       message='Message', recipient_list=['user@example.com'])
+            self.delivery.flush()
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual((self.delivery.sent, self.delivery.failed), (0, 1))
+        self.assertTrue(logger.error.called)
+
+    def test_connection_errors_are_counted(self):
+        with mock.patch('moderation.message_backends.get_connection',
+                        side_effect=ImportError('No backend')), \
+                mock.patch('moderation.message_backends.logger') as logger:
+            self.delivery.submit([EmailMessage('Subject 0'),
+                                  EmailMessage('Subject 1')])
+            self.delivery.flush()
+
+        self.assertEqual((self.delivery.sent, self.delivery.failed,
+                          self.delivery.pending), (0, 2, 0))
+        self.assertTrue(logger.error.called)
+
+    def test_reconnects_before_anything_is_sent(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages',
+                        side_effect=[SMTPServerDisconnected('Closed'),
+                                     1, 1]) as send_messages:
+            self.delivery.submit([EmailMessage('Subject 0'),
+                                  EmailMessage('Subject 1')])
+            self.delivery.flush()
+
+        self.assertEqual(send_messages.call_count, 3)
+        self.assertEqual((self.delivery.sent, self.delivery.failed), (2, 0))
+
+    def test_sent_messages_are_not_sent_again(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages',
+                        side_effect=[1, SMTPServerDisconnected('Closed')]) \
+                as send_messages, \
+                mock.patch('moderation.message_backends.logger') as logger:
+            self.delivery.submit([EmailMessage('Subject %s' % i)
+                                  for i in range(3)])
+            self.delivery.flush()
+
+        self.assertEqual(send_messages.call_count, 2)
+        self.assertEqual((self.delivery.sent, self.delivery.failed), (1, 2))
+        self.assertTrue(logger.error.called)
+
+    def test_submit_blocks_when_full(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def send_messages(self, messages):
+            started.set()
+            release.wait()
+            return len(messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages', send_messages):
+            # Two running and one waiting fill the pool
+            for i in range(3):
+                self.delivery.submit([EmailMessage('Subject %s' % i)])
+            started.wait()
+
+            fourth = threading.Thread(target=self.delivery.submit,
+                                      args=([EmailMessage('Subject 3')],))
+            fourth.start()
+            fourth.join(0.1)
+            self.assertTrue(fourth.is_alive())
+
+            release.set()
+            fourth.join()
+            self.delivery.flush()
+
+        self.assertEqual(self.delivery.sent, 4)
+
+
+class PooledMessageBackendTestCase(TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(idle_timeout=60)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def _send(self, backend_class, *args, **kwargs):
+        with mock.patch('moderation.message_backends.get_connection_pool',
+                        return_value=self.pool):
+            backend_class().send(*args, **kwargs)
+
+    def _send_all(self):
+        self._send(PooledEmailMessageBackend, subject='Subject',
+                   message='Message', recipient_list=['user@example.com'])
+        self._send(PooledEmailMultipleMessageBackend, [
+            {'subject': 'Subject %s' % i,
+             'message': 'Message %s' % i,
+             'recipient_list': ['user%s@example.com' % i]}
+            for i in range(2)])
+
+    def test_connection_is_reused(self):
+        with mock.patch('moderation.message_backends.get_connection',
+                        wraps=get_connection) as connect:
+            self._send_all()
+
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual((self.pool.sent, self.pool.failed,
+                          self.pool.batches), (3, 0, 2))
+        self.assertTrue(self.pool.max_send_time >= 0)
+
+    def test_idle_connection_is_reopened(self):
+        self.pool.idle_timeout = 0
+        with mock.patch('moderation.message_backends.get_connection',
+                        wraps=get_connection) as connect:
+            self._send_all()
+
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(len(self.pool.connections), 1)
+
+    def test_reconnects_after_connection_error(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages',
+                        side_effect=[SMTPServerDisconnected('Closed'), 1]):
+            self._send(PooledEmailMessageBackend, subject='Subject',
+                       message='Message', recipient_list=['user@example.com'])
+
+        self.assertEqual((self.pool.sent, self.pool.failed), (1, 0))
+
+    def test_other_errors_are_not_retried(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages',
+                        side_effect=[SMTPException('Recipient refused'), 1]) \
+                as send_messages, \
+                mock.patch('moderation.message_backends.logger') as logger:
+            self._send(PooledEmailMessageBackend, subject='Subject',
+                       message='Message', recipient_list=['user@example.com'])
+
+        self.assertEqual(send_messages.call_count, 1)
+        self.assertEqual((self.pool.sent, self.pool.failed), (0, 1))
+        self.assertTrue(logger.error.called)
+
+    def test_sent_messages_are_not_sent_again(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages',
+                        side_effect=[1, SMTPServerDisconnected('Closed'), 1]) \
+                as send_messages, \
+                mock.patch('moderation.message_backends.logger') as logger:
+            self._send(PooledEmailMultipleMessageBackend, [
+                {'subject': 'Subject %s' % i,
+                 'message': 'Message %s' % i,
+                 'recipient_list': ['user%s@example.com' % i]}
+                for i in range(2)])
+
+        self.assertEqual(send_messages.call_count, 2)
+        self.assertEqual((self.pool.sent, self.pool.failed), (1, 1))
+        self.assertTrue(logger.error.called)
+
+    def test_failed_messages_are_counted(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.'
+                        'send_messages',
+                        side_effect=SMTPException('Connection refused')), \
+                mock.patch('moderation.message_backends.logger') as logger:
+            self._send(PooledEmailMessageBackend, subject='Subject',
+                       message='Message', recipient_list=['user@example.com'])
+
+        self.assertEqual((self.pool.sent, self.pool.failed), (0, 1))
+        self.assertTrue(logger.error.called)
+
+    def test_connection_errors_are_counted(self):
+        with mock.patch('moderation.message_backends.get_connection',
+                        side_effect=ImportError('No backend')) as connect:
+            with mock.patch('moderation.message_backends.logger') as logger:
+                self._send(PooledEmailMessageBackend, subject='Subject',
+                           message='Message',
+                           recipient_list=['user@example.com'])
+
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual((self.pool.sent, self.pool.failed), (0, 1))
+        self.assertEqual(logger.error.call_count, 1)
@@ -124,6 +124,110 @@ class SerializationTestCase(TestCase):
         self.assertEqual(moderated_object.changed_object.description,
                          'New changed description')
 
+    def test_changed_object_is_deserialized_on_first_access(self):
+        from mock import patch
+
+        moderated_object = ModeratedObject(content_object=self.profile)
+        moderated_object.save()
+
+        with patch.object(SerializedObjectField, '_deserialize',
+                          wraps=moderated_object._meta.get_field(
+                              'changed_object')._deserialize) as deserialize:
+            moderated_object = ModeratedObject.objects.get(
+                pk=moderated_object.pk)
+            self.assertFalse(deserialize.called)
+
+            self.assertEqual(moderated_object.changed_object.description,
+                             'Old description')
+            moderated_object.changed_object
+            self.assertEqual(deserialize.call_count, 1)
+
+    def test_save_without_accessing_changed_object(self):
+        moderated_object = ModeratedObject(content_object=self.profile)
+        moderated_object.save()
+
+        moderated_object = ModeratedObject.objects.get(pk=moderated_object.pk)
+        moderated_object.reason = 'Untouched'
+        moderated_object.save()
+
+        moderated_object = ModeratedObject.objects.get(pk=moderated_object.pk)
+        self.assertEqual(moderated_object.changed_object.description,
+                         'Old description')
+
+    def test_deferred_changed_object(self):
+        moderated_object = ModeratedObject(content_object=self.profile)
+        moderated_object.save()
+
+        moderated_object = ModeratedObject.objects.defer(
+            'changed_object').get(pk=moderated_object.pk)
+
+        self.assertEqual(moderated_object.changed_object.description,
+                         'Old description')
+
+    def test_unloaded_changed_object_before_django_18(self):
+        from mock import patch
+
+        moderated_object = ModeratedObject(content_object=self.profile)
+        moderated_object.save()
+
+        moderated_object = ModeratedObject.objects.get(pk=moderated_object.pk)
+        del moderated_object.__dict__['changed_object']
+
+        with patch('moderation.fields.django_18', return_value=False):
+            self.assertEqual(moderated_object.changed_object.description,
+                             'Old description')
+
+    def test_post_init_receiver_is_scoped_to_model_and_subclasses(self):
+        from django.apps.registry import Apps
+        from django.db.models.signals import post_init
+        from mock import patch
+
+        # Kept out of the app registry, like isolate_apps() on Django 1.10
+        test_apps = Apps(['tests'])
+
+        with patch.object(SerializedObjectField, 'post_init', autospec=True,
+                          side_effect=SerializedObjectField.post_init) \
+                as receiver:
+            class Snapshot(models.Model):
+                snapshot = SerializedObjectField()
+
+                class Meta:
+                    app_label = 'tests'
+                    apps = test_apps
+
+            class ProxySnapshot(Snapshot):
+                class Meta:
+                    app_label = 'tests'
+                    apps = test_apps
+                    proxy = True
+
+            class ChildSnapshot(Snapshot):
+                class Meta:
+                    app_label = 'tests'
+                    apps = test_apps
+
+            value = SerializedObjectField()._serialize(self.profile)
+
+            self.assertEqual(Snapshot(snapshot=value).snapshot.description,
+                             'Old description')
+            self.assertEqual(
+                ProxySnapshot(snapshot=value).snapshot.description,
+                'Old description')
+            self.assertEqual(
+                ChildSnapshot(snapshot=value).snapshot.description,
+                'Old description')
+            self.assertEqual(receiver.call_count, 3)
+
+            # Instantiating unrelated models doesn't call the receiver
+            User()
+            Group()
+            UserProfile()
+            self.assertEqual(receiver.call_count, 3)
+
+        self.assertFalse(post_init.has_listeners(User))
+        self.assertFalse(post_init.has_listeners(UserProfile))
+        self.assertFalse(post_init.has_listeners(ModeratedObject))
+
     @unittest.skipIf(VERSION[:2] < (1, 4), "Proxy models require 1.4")
     def test_serialize_proxy_model(self):
         "Handle proxy models in the serialization."
@@ -157,6 +261,175 @@ class SerializationTestCase(TestCase):
         self.assertEqual(profile.user_id, 2)
 
 
+@unittest.skipIf(VERSION[:2] < (1, 8), "Fast path requires 1.8")
+class FastPathSerializationTestCase(TestCase):
+    fixtures = ['test_users.json', 'test_moderation.json']
+
+    def setUp(self):
+        self.profile = UserProfile.objects.get(user__username='moderator')
+
+    def test_dumps_matches_django_serializer(self):
+        import json
+        from django.core import serializers
+        from moderation import serialization
+
+        profile = SuperUserProfile(description='Profile for new super user',
+                                   url='http://www.test.com',
+                                   user=User.objects.get(username='user1'),
+                                   super_power='invisibility')
+        profile.save()
+
+        for objects in ([self.profile], [profile, profile.userprofile_ptr],
+                        [ProxyProfile.objects.get(pk=self.profile.pk)]):
+            # Key order of the documents differs before Django 1.9
+            self.assertEqual(
+                json.loads(serialization.dumps(objects)),
+                json.loads(serializers.serialize('json', objects)))
+
+    def test_loads(self):
+        from moderation import serialization
+
+        profile = serialization.loads(
+            serialization.dumps([self.profile]))
+
+        self.assertTrue(isinstance(profile, UserProfile))
+        self.assertEqual(profile.pk, self.profile.pk)
+        self.assertEqual(profile.user_id, self.profile.user_id)
+        self.assertEqual(profile.description, 'Old description')
+
+    def test_loads_leaves_inheritance_to_django(self):
+        from moderation import serialization
+
+        value = '[{"pk": 2, "model": "tests.superuserprofile",'\
+                ' "fields": {"super_power": "invisibility"}}, '\
+                '{"pk": 2, "model": "tests.userprofile", "fields":'\
+                ' {"url": "http://www.test.com", "user": 2,'\
+                ' "description": "Profile for new super user"}}]'
+
+        self.assertRaises(serialization.Unsupported,
+                          serialization.loads, value)
+
+    def test_loads_ignores_removed_fields(self):
+        from moderation import serialization
+
+        value = '[{"pk": 1, "model": "tests.userprofile", "fields": '\
+                '{"url": "http://www.google.com", "user": 1, '\
+                '"removed": "value", "description": "Profile"}}]'
+
+        profile = serialization.loads(value)
+
+        self.assertEqual(profile.description, 'Profile')
+
+    def test_older_django_falls_back_to_serializers(self):
+        from mock import patch
+        from moderation import serialization
+
+        with patch('moderation.serialization.django_18',
+                   return_value=False):
+            self.assertRaises(serialization.Unsupported,
+                              serialization.dumps, [self.profile])
+
+            json_field = SerializedObjectField()
+            profile = json_field._deserialize(
+                json_field._serialize(self.profile))
+
+        self.assertEqual(profile.description, 'Old description')
+
+
+class CompactSerializationTestCase(TestCase):
+    fixtures = ['test_users.json', 'test_moderation.json']
+
+    def setUp(self):
+        self.profile = UserProfile.objects.get(user__username='moderator')
+        self.field = SerializedObjectField(serialize_format='compact')
+
+    def test_serialize_is_binary(self):
+        serialized = self.field._serialize(self.profile)
+
+        self.assertTrue(isinstance(serialized, bytes))
+        self.assertTrue(serialized.startswith(b'\x00mc'))
+        self.assertTrue(len(serialized) <
+                        len(SerializedObjectField()._serialize(self.profile)))
+
+    def test_round_trip(self):
+        self.profile.description = 'New description'
+
+        profile = self.field._deserialize(self.field._serialize(self.profile))
+
+        self.assertTrue(isinstance(profile, UserProfile))
+        self.assertEqual(profile.pk, self.profile.pk)
+        self.assertEqual(profile.user_id, self.profile.user_id)
+        self.assertEqual(profile.description, 'New description')
+
+    def test_round_trip_with_inheritance(self):
+        profile = SuperUserProfile(description='Profile for new super user',
+                                   url='http://www.test.com',
+                                   user=User.objects.get(username='user1'),
+                                   super_power='invisibility')
+        profile.save()
+        profile.description = 'Changed description'
+
+        value = self.field._serialize(profile)
+        profile = self.field._deserialize(memoryview(value))
+
+        self.assertTrue(isinstance(profile, SuperUserProfile))
+        self.assertEqual(profile.super_power, 'invisibility')
+        self.assertEqual(profile.description, 'Changed description')
+
+    def test_round_trip_proxy_model(self):
+        profile = ProxyProfile.objects.get(pk=self.profile.pk)
+
+        profile = self.field._deserialize(self.field._serialize(profile))
+
+        self.assertTrue(isinstance(profile, ProxyProfile))
+
+    def test_deserialize_json_rows(self):
+        value = SerializedObjectField()._serialize(self.profile)
+
+        for raw in (value, value.encode('utf-8')):
+            profile = self.field._deserialize(raw)
+            self.assertTrue(isinstance(profile, UserProfile))
+            self.assertEqual(profile.description, 'Old description')
+
+    def test_resave_unread_json_row(self):
+        from django.db import connection
+
+        field = SerializedObjectField(serialize_format='compact', lazy=True)
+        field.set_attributes_from_name('changed_object')
+        moderated_object = ModeratedObject()
+        moderated_object.__dict__['changed_object'] = \
+            SerializedObjectField()._serialize(self.profile)
+
+        value = field.get_db_prep_value(
+            field.pre_save(moderated_object, False), connection)
+
+        profile = field._deserialize(value)
+        self.assertTrue(isinstance(profile, UserProfile))
+        self.assertEqual(profile.description, 'Old description')
+
+    def test_binary_column(self):
+        from django.db import connection
+
+        self.assertEqual(self.field.db_type(connection),
+                         models.BinaryField().db_type(connection))
+        self.assertEqual(SerializedObjectField().db_type(connection), 'text')
+
+    def test_deconstruct(self):
+        kwargs = self.field.deconstruct()[3]
+        self.assertEqual(kwargs['serialize_format'], 'compact')
+
+        kwargs = SerializedObjectField().deconstruct()[3]
+        self.assertNotIn('serialize_format', kwargs)
+        self.assertNotIn('lazy', kwargs)
+
+    def test_deconstruct_lazy(self):
+        field = SerializedObjectField(serialize_format='compact', lazy=True)
+        kwargs = field.deconstruct()[3]
+        self.assertTrue(kwargs['lazy'])
+
+        self.assertTrue(field.clone().lazy)
+
+
 class ModerateTestCase(TestCase):
     fixtures = ['test_users.json', 'test_moderation.json']
 
@@ -202,7 +475,7 @@ class ModerateTestCase(TestCase):
         self.assertEqual(self.profile.moderated_object.by, self.user)
         self.assertEqual(self.profile.moderated_object.reason, "Reason")
 
-    def test_multiple_moderations_throws_exception_by_default(self):
+    def test_multiple_moderations_throws_exception_when_checked(self):
         self.profile.description = 'New description'
         self.profile.save()
 
@@ -210,9 +483,34 @@ class ModerateTestCase(TestCase):
             content_object=self.profile)
         moderated_object.approve(by=self.user)
 
+        self.moderation.get_moderator(
+            self.profile.__class__).check_multiple_moderations = True
+
+        with self.assertRaises(ModerationObjectsManager.MultipleModerations):
+            self.profile.__class__.objects.get(id=self.profile.id)
+
+    def test_multiple_moderations_are_checked_with_keep_history(self):
+        self.moderation.get_moderator(
+            self.profile.__class__).keep_history = True
+
+        self.profile.description = 'New description'
+        self.profile.save()
+        self.profile.moderated_object.approve(by=self.user)
+        self.profile.description = 'Newer description'
+        self.profile.save()
+
         with self.assertRaises(ModerationObjectsManager.MultipleModerations):
             self.profile.__class__.objects.get(id=self.profile.id)
 
+    def test_multiple_moderations_are_not_checked_by_default(self):
+        model_class = self.profile.__class__
+        with self.assertNumQueries(1):
+            list(model_class.objects.all())
+
+        self.assertQuerysetEqual(
+            model_class.objects.find_multiple_moderations(
+                model_class.unmoderated_objects.all()), [])
+
     def test_approve_new_moderated_object(self):
         """
         When a newly created object is approved, it should become visible
@@ -1,17 +1,29 @@
 from __future__ import unicode_literals
+import datetime
 import unittest
 
+import mock
+
 from django.test.testcases import TestCase
+from django.test.utils import override_settings
 from tests.models import UserProfile,\
-    ModelWithVisibilityField, ModelWithWrongVisibilityField
-from moderation.moderator import GenericModerator
+    ModelWithVisibilityField, ModelWithWrongVisibilityField,\
+    ModelWithStateField
+from moderation import moderator as moderator_module
+from moderation.moderator import (GenericModerator, get_current_site,
+                                  get_group_ids)
 from moderation.managers import ModerationObjectsManager
-from django.core import mail
+from django.core import mail, management
+from django.core.cache import cache
+from django.utils import timezone
 from django.contrib.auth.models import User, Group
-from moderation.models import ModeratedObject
-from moderation.constants import MODERATION_STATUS_APPROVED
+from django.contrib.sites.models import Site
+from moderation.models import ModeratedObject, ModeratorDigestEntry
+from moderation.constants import (MODERATION_STATUS_APPROVED,
+                                  MODERATION_DRAFT_STATE,
+                                  MODERATION_READY_STATE)
 from moderation.message_backends import BaseMessageBackend
-from moderation.utils import django_110
+from moderation.utils import django_110, django_18
 from django.db.models.manager import Manager
 from tests.utils import setup_moderation, teardown_moderation
 
@@ -118,6 +130,60 @@ class GenericModeratorTestCase(TestCase):
         self.moderator.inform_user(self.user, self.user)
         self.assertEqual(len(mail.outbox), 1)
 
+    def test_inform_users(self):
+        profile = UserProfile.objects.get(user__username='moderator')
+        ModeratedObject(content_object=profile, changed_by=self.user,
+                        status=MODERATION_STATUS_APPROVED).save()
+
+        self.moderator.inform_users(
+            ModeratedObject.objects.filter(changed_by=self.user))
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject,
+                         'user profile entry has been accepted')
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+
+    def test_inform_users_extra_context_wins(self):
+        profile = UserProfile.objects.get(user__username='moderator')
+        ModeratedObject(content_object=profile, changed_by=self.user,
+                        status=MODERATION_STATUS_APPROVED).save()
+
+        self.moderator.inform_users(
+            ModeratedObject.objects.filter(changed_by=self.user),
+            extra_context={'content_type': 'profile'})
+
+        self.assertEqual(mail.outbox[0].subject,
+                         'profile entry has been accepted')
+
+    def test_templates_are_loaded_once(self):
+        moderator_module._templates.clear()
+        with mock.patch('moderation.moderator.loader.get_template',
+                        wraps=moderator_module.loader.get_template) as get:
+            self.moderator.inform_moderator(self.user)
+            self.moderator.inform_moderator(self.user)
+
+            self.assertEqual(get.call_count, 2)
+            self.assertEqual(len(mail.outbox), 2)
+
+            with override_settings(TEMPLATES=[{
+                    'BACKEND': 'django.template.backends.django.'
+                               'DjangoTemplates',
+                    'APP_DIRS': True}]):
+                self.moderator.inform_moderator(self.user)
+
+            self.assertEqual(get.call_count, 4)
+
+    def test_templates_are_not_cached_with_debug(self):
+        moderator_module._templates.clear()
+        with mock.patch('moderation.moderator.loader.get_template',
+                        wraps=moderator_module.loader.get_template) as get, \
+                override_settings(DEBUG=True):
+            self.moderator.inform_moderator(self.user)
+            self.moderator.inform_moderator(self.user)
+
+        self.assertEqual(get.call_count, 4)
+        self.assertEqual(moderator_module._templates, {})
+
     def test_moderator_should_have_field_exclude(self):
         self.assertTrue(hasattr(self.moderator, 'fields_exclude'))
 
@@ -126,10 +192,14 @@ class AutoModerateModeratorTestCase(TestCase):
     fixtures = ['test_users.json']
 
     def setUp(self):
+        cache.clear()
         self.user = User.objects.get(username='admin')
         self.moderator = GenericModerator(UserProfile)
         self.obj = object
 
+    def tearDown(self):
+        cache.clear()
+
     def test_is_auto_approve_user_superuser(self):
         self.moderator.auto_approve_for_superusers = True
         self.user.is_superuser = True
@@ -175,6 +245,93 @@ class AutoModerateModeratorTestCase(TestCase):
         self.moderator.auto_approve_for_groups = ['banned']
         self.assertFalse(self.moderator.is_auto_approve(self.obj, self.user))
 
+    def test_auto_approve_for_groups_with_missing_group(self):
+        self.moderator.auto_approve_for_superusers = False
+        self.moderator.auto_approve_for_staff = False
+        self.moderator.auto_approve_for_groups = ['missing', 'moderators']
+        group = Group.objects.create(name='moderators')
+        self.user.groups.add(group)
+
+        reason = self.moderator.is_auto_approve(self.obj, self.user)
+        self.assertEqual(reason, 'Auto-approved: User in allowed group')
+
+    def test_groups_of_user_are_checked_with_one_query(self):
+        self.moderator.auto_approve_for_superusers = False
+        self.moderator.auto_approve_for_staff = False
+        self.moderator.auto_approve_for_groups = ['moderators', 'admins']
+        self.moderator.auto_reject_for_groups = ['banned']
+        for name in ('moderators', 'admins', 'banned'):
+            Group.objects.create(name=name)
+        self.user.groups.add(Group.objects.get(name='admins'))
+        get_group_ids(['moderators', 'admins', 'banned'])
+
+        with self.assertNumQueries(1):
+            self.assertFalse(self.moderator.is_auto_reject(self.obj,
+                                                           self.user))
+            self.assertTrue(self.moderator.is_auto_approve(self.obj,
+                                                           self.user))
+
+    def test_group_ids_are_cleared_on_group_changes(self):
+        self.moderator.auto_approve_for_superusers = False
+        self.moderator.auto_approve_for_staff = False
+        self.moderator.auto_approve_for_groups = ['moderators']
+        self.assertFalse(self.moderator.is_auto_approve(self.obj, self.user))
+
+        group = Group.objects.create(name='moderators')
+        self.user.groups.add(group)
+        self.assertTrue(self.moderator.is_auto_approve(self.obj, self.user))
+
+        group.user_set.remove(self.user)
+        self.assertFalse(self.moderator.is_auto_approve(self.obj, self.user))
+
+    def test_group_ids_are_kept_on_other_m2m_changes(self):
+        from django.contrib.auth.models import Permission
+
+        version = moderator_module._user_groups_version
+        self.user.user_permissions.add(Permission.objects.all()[0])
+        self.assertEqual(moderator_module._user_groups_version, version)
+
+        self.user.groups.add(Group.objects.create(name='moderators'))
+        self.assertEqual(moderator_module._user_groups_version, version + 1)
+
+    def test_groups_created_elsewhere_are_found(self):
+        self.moderator.auto_approve_for_superusers = False
+        self.moderator.auto_approve_for_staff = False
+        self.moderator.auto_approve_for_groups = ['moderators']
+        self.assertFalse(self.moderator.is_auto_approve(self.obj, self.user))
+
+        # Sends no post_save, like a group created by another process
+        Group.objects.bulk_create([Group(name='moderators')])
+        self.user.groups.add(Group.objects.get(name='moderators'))
+
+        self.assertTrue(self.moderator.is_auto_approve(self.obj, self.user))
+
+    def test_groups_renamed_elsewhere_are_found_after_timeout(self):
+        self.moderator.auto_approve_for_superusers = False
+        self.moderator.auto_approve_for_staff = False
+        self.moderator.auto_approve_for_groups = ['moderators']
+        group = Group.objects.create(name='moderators')
+        self.user.groups.add(group)
+        self.assertTrue(self.moderator.is_auto_approve(self.obj, self.user))
+
+        # Sends no post_save, like a group renamed by another process
+        Group.objects.filter(pk=group.pk).update(name='banned')
+        self.assertTrue(self.moderator.is_auto_approve(self.obj, self.user))
+
+        cache.delete(moderator_module.GROUP_IDS_CACHE_KEY)
+        self.assertFalse(self.moderator.is_auto_approve(self.obj, self.user))
+
+    def test_group_ids_are_not_cached_without_cache(self):
+        group = Group.objects.create(name='moderators')
+
+        with mock.patch('moderation.conf.settings.GROUP_CACHE', None):
+            self.assertEqual(get_group_ids(['moderators']), set([group.pk]))
+            Group.objects.filter(pk=group.pk).update(name='banned')
+            self.assertEqual(get_group_ids(['moderators']), set())
+
+        self.assertEqual(cache.get(moderator_module.GROUP_IDS_CACHE_KEY),
+                         None)
+
     def test_is_auto_reject_user_is_anonymous(self):
         from mock import Mock
 
@@ -355,3 +512,337 @@ class VisibilityColumnTestCase(TestCase):
         self.assertEqual(
             ModelWithVisibilityField.unmoderated_objects.get().is_public,
             True)
+
+
+class StateColumnTestCase(TestCase):
+    fixtures = ['test_users.json', 'test_moderation.json']
+
+    def setUp(self):
+
+        class StateModerator(GenericModerator):
+            state_column = 'moderation_state'
+
+        self.moderation = setup_moderation([(ModelWithStateField,
+                                             StateModerator)])
+
+        self.user = User.objects.get(username='moderator')
+
+    def tearDown(self):
+        teardown_moderation()
+
+    def _create_object(self):
+        obj = ModelWithStateField(test='Object for new user')
+        obj.save()
+        return obj
+
+    def _get_state(self, obj):
+        return ModelWithStateField.unmoderated_objects.get(
+            pk=obj.pk).moderation_state
+
+    def test_new_object_is_in_draft_state(self):
+        obj = self._create_object()
+
+        self.assertEqual(self._get_state(obj), MODERATION_DRAFT_STATE)
+        self.assertEqual(list(ModelWithStateField.objects.all()), [])
+
+    def test_approved_object_is_returned_by_manager(self):
+        obj = self._create_object()
+        obj.moderated_object.approve(self.user)
+
+        self.assertEqual(self._get_state(obj), MODERATION_READY_STATE)
+        self.assertEqual(list(ModelWithStateField.objects.all()), [obj])
+
+    def test_manager_does_not_join_moderated_objects(self):
+        query = str(ModelWithStateField.objects.all().query)
+
+        self.assertNotIn(ModeratedObject._meta.db_table, query)
+
+    def test_saves_without_changes_keep_status(self):
+        obj = self._create_object()
+        # Has the state written to the table, unlike the changed_object
+        ModelWithStateField.unmoderated_objects.get(pk=obj.pk).save()
+        ModeratedObject.objects.get_for_instance(obj).approve(self.user)
+        mail.outbox = []
+
+        # Still holds the draft state from before the approval
+        obj.save()
+        obj.save()
+
+        self.assertEqual(ModeratedObject.objects.get_for_instance(obj).status,
+                         MODERATION_STATUS_APPROVED)
+        self.assertEqual(self._get_state(obj), MODERATION_READY_STATE)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_saving_same_instance_again_keeps_draft_state(self):
+        obj = self._create_object()
+        self.assertEqual(obj.moderation_state, MODERATION_DRAFT_STATE)
+
+        obj.save()
+
+        self.assertEqual(self._get_state(obj), MODERATION_DRAFT_STATE)
+        self.assertEqual(list(ModelWithStateField.objects.all()), [])
+
+    def test_changes_keep_approved_state(self):
+        obj = self._create_object()
+        obj.moderated_object.approve(self.user)
+
+        obj.test = 'Changed'
+        obj.save()
+
+        self.assertEqual(self._get_state(obj), MODERATION_READY_STATE)
+        self.assertEqual(ModelWithStateField.objects.get().test,
+                         'Object for new user')
+
+        obj.moderated_object.approve(self.user)
+
+        self.assertEqual(self._get_state(obj), MODERATION_READY_STATE)
+        self.assertEqual(ModelWithStateField.objects.get().test, 'Changed')
+
+    def test_bulk_approve_updates_state(self):
+        objs = [self._create_object() for i in range(3)]
+
+        ModeratedObject.objects.all().approve(by=self.user)
+
+        for obj in objs:
+            self.assertEqual(self._get_state(obj), MODERATION_READY_STATE)
+        self.assertEqual(ModelWithStateField.objects.count(), 3)
+
+    def test_keep_history_keeps_approved_object_visible(self):
+        moderator = self.moderation.get_moderator(ModelWithStateField)
+        moderator.keep_history = True
+        obj = self._create_object()
+        obj.moderated_object.approve(self.user)
+
+        obj.test = 'Changed'
+        obj.save()
+
+        self.assertEqual(ModeratedObject.objects.count(), 2)
+        self.assertEqual(self._get_state(obj), MODERATION_READY_STATE)
+        self.assertEqual(ModelWithStateField.objects.get().test,
+                         'Object for new user')
+
+        ModeratedObject.objects.get_for_instance(obj).reject(self.user)
+
+        self.assertEqual(self._get_state(obj), MODERATION_READY_STATE)
+        self.assertEqual(ModelWithStateField.objects.get().test,
+                         'Object for new user')
+
+    def test_keep_history_keeps_new_object_hidden(self):
+        moderator = self.moderation.get_moderator(ModelWithStateField)
+        moderator.keep_history = True
+        obj = self._create_object()
+
+        obj.test = 'Changed'
+        obj.save()
+
+        self.assertEqual(ModeratedObject.objects.count(), 2)
+        self.assertEqual(self._get_state(obj), MODERATION_DRAFT_STATE)
+        self.assertEqual(list(ModelWithStateField.objects.all()), [])
+
+    def test_saving_moderated_object_keeps_unchanged_state(self):
+        obj = self._create_object()
+        moderated_object = ModeratedObject.objects.get_for_instance(obj)
+        moderated_object.reason = 'Reason'
+
+        # Only the UPDATE of the ModeratedObject
+        with self.assertNumQueries(1):
+            moderated_object.save()
+
+    def test_deleting_moderated_object_updates_state(self):
+        obj = self._create_object()
+
+        obj.moderated_object.delete()
+
+        self.assertEqual(self._get_state(obj), MODERATION_READY_STATE)
+        self.assertEqual(list(ModelWithStateField.objects.all()), [obj])
+
+    def test_invalid_state_column_field_should_rise_exception(self):
+
+        class StateModerator(GenericModerator):
+            state_column = 'is_public'
+
+        self.assertRaises(AttributeError,
+                          self.moderation.register,
+                          ModelWithVisibilityField,
+                          StateModerator)
+
+
+class ModeratorDigestTestCase(TestCase):
+    fixtures = ['test_users.json', 'test_moderation.json']
+
+    def setUp(self):
+
+        class UserProfileModerator(GenericModerator):
+            moderator_digest = True
+            digest_max_size = 3
+
+        self.moderation = setup_moderation([(UserProfile,
+                                             UserProfileModerator)])
+        self.moderator = self.moderation.get_moderator(UserProfile)
+        self.user = User.objects.get(username='user1')
+
+    def tearDown(self):
+        teardown_moderation()
+
+    def _create_profile(self):
+        profile = UserProfile(description='Profile for new user',
+                              url='http://www.test.com',
+                              user=self.user)
+        profile.save()
+        return profile
+
+    def test_notifications_are_collected(self):
+        profile = self._create_profile()
+        self.moderator.inform_moderator(profile)
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(ModeratorDigestEntry.objects.get().moderated_object,
+                         profile.moderated_object)
+
+    def test_digest_is_sent_once_full(self):
+        profiles = [self._create_profile() for i in range(3)]
+        self.assertEqual(len(mail.outbox), 0)
+
+        management.call_command('send_moderation_digests')
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['test@example.com'])
+        self.assertEqual(mail.outbox[0].subject,
+                         '3 new user profile entries need to be moderated')
+        for profile in profiles:
+            self.assertIn(profile.moderated_object.get_admin_moderate_url(),
+                          mail.outbox[0].body)
+        self.assertFalse(ModeratorDigestEntry.objects.exists())
+
+    def test_digest_is_sent_once_due(self):
+        self._create_profile()
+        self._create_profile()
+
+        management.call_command('send_moderation_digests')
+        self.assertEqual(len(mail.outbox), 0)
+
+        ModeratorDigestEntry.objects.update(
+            created=timezone.now() - datetime.timedelta(hours=2))
+        management.call_command('send_moderation_digests')
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject,
+                         '2 new user profile entries need to be moderated')
+
+    def test_send_moderation_digests_command_all(self):
+        self._create_profile()
+
+        management.call_command('send_moderation_digests', all=True)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(ModeratorDigestEntry.objects.exists())
+
+        management.call_command('send_moderation_digests', all=True)
+
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_moderated_changes_are_left_out(self):
+        approved = self._create_profile()
+        pending = self._create_profile()
+        approved.moderated_object.approve(by=self.user)
+
+        self.moderator.send_digest()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject,
+                         '1 new user profile entries need to be moderated')
+        self.assertNotIn(approved.moderated_object.get_admin_moderate_url(),
+                         mail.outbox[0].body)
+        self.assertIn(pending.moderated_object.get_admin_moderate_url(),
+                      mail.outbox[0].body)
+        self.assertFalse(ModeratorDigestEntry.objects.exists())
+
+    def test_claimed_entries_are_not_sent(self):
+        self._create_profile()
+        ModeratorDigestEntry.objects.update(claim='other')
+
+        self.moderator.send_digest()
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertTrue(ModeratorDigestEntry.objects.exists())
+
+    def test_stale_claims_are_taken_over(self):
+        self._create_profile()
+        ModeratorDigestEntry.objects.update(
+            claim='other',
+            claimed=timezone.now() - datetime.timedelta(seconds=601))
+
+        self.moderator.send_digest(claim_timeout=600)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(ModeratorDigestEntry.objects.exists())
+
+    def test_entries_are_kept_when_sending_fails(self):
+        self._create_profile()
+
+        with mock.patch('moderation.message_backends.send_mass_mail',
+                        side_effect=ValueError('Invalid address')), \
+                self.assertRaises(ValueError):
+            self.moderator.send_digest()
+
+        entry = ModeratorDigestEntry.objects.get()
+        self.assertEqual(entry.claim, '')
+
+        self.moderator.send_digest()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(ModeratorDigestEntry.objects.exists())
+
+    def test_entries_are_kept_when_messages_are_not_sent(self):
+        self._create_profile()
+
+        # The default backend fails silently
+        with mock.patch('django.core.mail.get_connection') as get_connection:
+            get_connection.return_value.send_messages.return_value = 0
+            self.moderator.send_digest()
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(ModeratorDigestEntry.objects.get().claim, '')
+
+
+class SiteCacheTestCase(TestCase):
+
+    def setUp(self):
+        moderator_module._sites.clear()
+        Site.objects.clear_cache()
+
+    def test_site_is_cached(self):
+        with self.assertNumQueries(1):
+            site = get_current_site()
+        Site.objects.clear_cache()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_site(), site)
+
+    def test_saving_site_clears_cache(self):
+        site = get_current_site()
+        site.name = 'renamed.example.com'
+        site.save()
+
+        self.assertEqual(get_current_site().name, 'renamed.example.com')
+
+    def test_changing_site_id_clears_cache(self):
+        get_current_site()
+        other = Site.objects.create(domain='other.example.com',
+                                    name='other.example.com')
+
+        with override_settings(SITE_ID=other.pk):
+            self.assertEqual(get_current_site(), other)
+        self.assertNotEqual(get_current_site(), other)
+
+    @unittest.skipIf(not django_18(), "Site.objects.get_current() "
+                                      "raises ImproperlyConfigured from 1.8")
+    def test_site_id_is_required(self):
+        from django.conf import settings
+        from django.core.exceptions import ImproperlyConfigured
+
+        get_current_site()
+
+        with override_settings():
+            del settings.SITE_ID
+            self.assertRaises(ImproperlyConfigured, get_current_site)
@@ -0,0 +1,261 @@
+from __future__ import unicode_literals
+
+import datetime
+
+import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test.testcases import TestCase
+
+from moderation.constants import (MODERATION_READY_STATE,
+                                  MODERATION_STATUS_APPROVED,
+                                  MODERATION_STATUS_REJECTED,
+                                  MODERATION_STATUS_PENDING)
+from moderation import message_backends
+from moderation.models import ModeratedObject
+from moderation.moderator import GenericModerator
+from moderation.queryset import save_base_objects
+from moderation.signals import (pre_moderation, pre_many_moderation,
+                                post_many_moderation)
+from tests.models import (UserProfile, SuperUserProfile,
+                          ModelWithDateField, ModelWithVisibilityField)
+from tests.utils import setup_moderation, teardown_moderation
+
+
+class ModeratedObjectQuerySetTestCase(TestCase):
+    fixtures = ['test_users.json', 'test_moderation.json']
+
+    def setUp(self):
+        class VisibilityModerator(GenericModerator):
+            visibility_column = 'is_public'
+
+        self.moderation = setup_moderation(
+            [UserProfile, (ModelWithVisibilityField, VisibilityModerator)])
+        self.user = User.objects.get(username='moderator')
+
+        self.profile = UserProfile.objects.get(user__username='moderator')
+        moderated_object = ModeratedObject(content_object=self.profile)
+        moderated_object.save()
+        moderated_object.approve(by=self.user)
+
+        self.profile.description = 'New description'
+        self.profile.save()
+
+        self.visible = ModelWithVisibilityField.objects.create(test='test')
+
+    def tearDown(self):
+        teardown_moderation()
+
+    def test_most_recent(self):
+        self.moderation.get_moderator(UserProfile).keep_history = True
+        profile = UserProfile.unmoderated_objects.get(pk=self.profile.pk)
+        profile.description = 'Newer description'
+        profile.save()
+
+        self.assertEqual(
+            set(ModeratedObject.objects.all().most_recent()),
+            set([ModeratedObject.objects.get_for_instance(profile),
+                 ModeratedObject.objects.get_for_instance(self.visible)]))
+
+    def test_approve_restores_pending_changes(self):
+        ModeratedObject.objects.filter(
+            status=MODERATION_STATUS_PENDING).approve(by=self.user)
+
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        self.assertEqual(profile.description, 'New description')
+
+        for mobj in ModeratedObject.objects.all():
+            self.assertEqual(mobj.status, MODERATION_STATUS_APPROVED)
+            self.assertEqual(mobj.state, MODERATION_READY_STATE)
+            self.assertEqual(mobj.by, self.user)
+
+    def test_approve_restores_newest_pending_changes(self):
+        self.moderation.get_moderator(UserProfile).keep_history = True
+        for description in ('first edit', 'second edit'):
+            profile = UserProfile.unmoderated_objects.get(pk=self.profile.pk)
+            profile.description = description
+            profile.save()
+        self.assertEqual(ModeratedObject.objects.filter(
+            object_pk=self.profile.pk, content_type__model='userprofile',
+            status=MODERATION_STATUS_PENDING).count(), 3)
+
+        ModeratedObject.objects.filter(
+            status=MODERATION_STATUS_PENDING).approve(by=self.user)
+
+        profile = UserProfile.unmoderated_objects.get(pk=self.profile.pk)
+        self.assertEqual(profile.description, 'second edit')
+
+    def test_approve_refreshes_updated(self):
+        mobj = ModeratedObject.objects.get_for_instance(self.profile)
+
+        ModeratedObject.objects.filter(pk=mobj.pk).approve(by=self.user)
+
+        self.assertTrue(
+            ModeratedObject.objects.get(pk=mobj.pk).updated > mobj.updated)
+
+    def test_reject_keeps_approved_data(self):
+        ModeratedObject.objects.all().reject(by=self.user, reason='No')
+
+        profile = UserProfile.unmoderated_objects.get(pk=self.profile.pk)
+        self.assertEqual(profile.description, 'Old description')
+
+        for mobj in ModeratedObject.objects.all():
+            self.assertEqual(mobj.status, MODERATION_STATUS_REJECTED)
+            self.assertEqual(mobj.reason, 'No')
+
+    def test_visibility_column(self):
+        ModeratedObject.objects.all().approve(by=self.user)
+        self.assertTrue(ModelWithVisibilityField.unmoderated_objects.get(
+            pk=self.visible.pk).is_public)
+
+        ModeratedObject.objects.all().reject(by=self.user)
+        self.assertFalse(ModelWithVisibilityField.unmoderated_objects.get(
+            pk=self.visible.pk).is_public)
+
+    def test_only_given_class_is_moderated(self):
+        ModeratedObject.objects.all().approve(UserProfile, by=self.user)
+
+        self.assertEqual(
+            ModeratedObject.objects.get_for_instance(self.visible).status,
+            MODERATION_STATUS_PENDING)
+        self.assertEqual(
+            ModeratedObject.objects.get_for_instance(self.profile).status,
+            MODERATION_STATUS_APPROVED)
+
+    def test_many_moderation_signals_per_content_type(self):
+        senders = []
+
+        def receiver(sender, **kwargs):
+            senders.append(sender)
+
+        pre_many_moderation.connect(receiver)
+        post_many_moderation.connect(receiver)
+        pre_moderation.connect(receiver)
+        try:
+            ModeratedObject.objects.all().approve(by=self.user)
+        finally:
+            pre_many_moderation.disconnect(receiver)
+            post_many_moderation.disconnect(receiver)
+            pre_moderation.disconnect(receiver)
+
+        self.assertEqual(sorted(senders, key=lambda cls: cls.__name__),
+                         [ModelWithVisibilityField, ModelWithVisibilityField,
+                          UserProfile, UserProfile])
+
+    def test_per_object_signals(self):
+        self.moderation.get_moderator(UserProfile).per_object_signals = True
+        senders = []
+
+        def receiver(sender, **kwargs):
+            senders.append(sender)
+
+        pre_moderation.connect(receiver)
+        try:
+            ModeratedObject.objects.filter(
+                content_type__model='userprofile').approve(by=self.user)
+        finally:
+            pre_moderation.disconnect(receiver)
+
+        self.assertEqual(senders, [UserProfile])
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        self.assertEqual(profile.description, 'New description')
+
+    def test_users_are_informed(self):
+        ModeratedObject.objects.all().update(changed_by=self.user)
+        mail.outbox = []
+
+        ModeratedObject.objects.all().approve(by=self.user)
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+
+    def test_approve_query_count_does_not_grow(self):
+        user = User.objects.get(username='user1')
+        for i in range(10):
+            profile = UserProfile.objects.create(
+                description='Profile %s' % i, url='http://www.test.com',
+                user=user)
+            profile.description = 'Changed %s' % i
+            profile.save()
+
+        queryset = ModeratedObject.objects.filter(
+            content_type__model='userprofile')
+        # Groups, savepoint and its release, pending changes, their write
+        # back, status update and the users to inform, whatever the number
+        # of objects
+        with self.assertNumQueries(7):
+            queryset.approve(by=self.user)
+
+        self.assertEqual(
+            sorted(UserProfile.objects.filter(user=user)
+                   .values_list('description', flat=True)),
+            ['Changed %s' % i for i in range(10)])
+
+    def test_inform_users_in_batches(self):
+        user = User.objects.get(username='user1')
+        for i in range(10):
+            UserProfile.objects.create(
+                description='Profile %s' % i, url='http://www.test.com',
+                user=user)
+        queryset = ModeratedObject.objects.filter(
+            content_type__model='userprofile')
+        queryset.update(changed_by=user, status=MODERATION_STATUS_APPROVED)
+        mail.outbox = []
+
+        moderator = self.moderation.get_moderator(UserProfile)
+        moderator.notification_batch_size = 4
+        with mock.patch('moderation.message_backends.get_connection',
+                        wraps=message_backends.get_connection) as connect:
+            # The pks, then the objects with their users and the content
+            # objects of each batch
+            with self.assertNumQueries(7):
+                moderator.inform_users(queryset)
+
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(len(mail.outbox), 11)
+        for message in mail.outbox:
+            self.assertEqual(message.subject,
+                             'user profile entry has been accepted')
+            self.assertEqual(message.to, [user.email])
+
+    def test_save_base_objects_with_inheritance(self):
+        profiles = []
+        for power in ('invisibility', 'flying'):
+            profile = SuperUserProfile(
+                description='Profile for new super user',
+                url='http://www.test.com', super_power=power,
+                user=User.objects.get(username='user1'))
+            profile.save()
+            profile.description = 'Changed %s' % power
+            profile.super_power = 'super %s' % power
+            profiles.append(profile)
+
+        # One UPDATE for each table
+        with self.assertNumQueries(2):
+            save_base_objects(profiles)
+
+        for profile in profiles:
+            saved = SuperUserProfile.objects.get(pk=profile.pk)
+            self.assertEqual(saved.description, profile.description)
+            self.assertEqual(saved.super_power, profile.super_power)
+
+    def test_save_base_objects_refreshes_auto_now_fields(self):
+        obj = ModelWithDateField.objects.create()
+        obj.date = datetime.date(2000, 1, 1)
+
+        save_base_objects([obj])
+
+        self.assertEqual(ModelWithDateField.objects.get(pk=obj.pk).date,
+                         datetime.date.today())
+
+    def test_approve_recreates_deleted_base_object(self):
+        mobj = ModeratedObject.objects.get_for_instance(self.profile)
+        # Skip the cascade to the moderated object
+        UserProfile.unmoderated_objects.filter(
+            pk=self.profile.pk)._raw_delete(using='default')
+
+        ModeratedObject.objects.filter(pk=mobj.pk).approve(by=self.user)
+
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        self.assertEqual(profile.description, 'New description')
@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 
 from django import VERSION
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core import management
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models.manager import Manager
@@ -11,7 +12,8 @@ from unittest import skipIf, skipUnless
 
 from moderation.constants import (MODERATION_STATUS_REJECTED,
                                   MODERATION_STATUS_APPROVED,
-                                  MODERATION_STATUS_PENDING)
+                                  MODERATION_STATUS_PENDING,
+                                  MODERATION_READY_STATE)
 from moderation.helpers import import_moderator
 from moderation.managers import ModerationObjectsManager
 from moderation.models import ModeratedObject
@@ -56,6 +58,49 @@ class RegistrationTestCase(TestCase):
 
         self.assertTrue(isinstance(moderator, GenericModerator))
 
+    def test_get_moderators(self):
+        self.assertEqual(self.moderation.get_moderators(),
+                         [self.moderation.get_moderator(UserProfile)])
+
+    def test_get_registry_entry(self):
+        content_type = ContentType.objects.get_for_model(UserProfile)
+
+        entry = self.moderation.get_registry_entry(content_type.pk)
+
+        self.assertEqual(entry.model_class, UserProfile)
+        self.assertEqual(entry.moderator,
+                         self.moderation.get_moderator(UserProfile))
+        self.assertEqual(entry.unmoderated_manager,
+                         UserProfile._default_unmoderated_manager)
+
+        with self.assertNumQueries(0):
+            self.assertIs(
+                self.moderation.get_registry_entry(content_type.pk), entry)
+
+    def test_get_registry_entry_follows_registrations(self):
+        content_type = ContentType.objects.get_for_model(Book)
+
+        self.assertIsNone(self.moderation.get_registry_entry(content_type.pk))
+
+        self.moderation.register(Book)
+        self.assertEqual(
+            self.moderation.get_registry_entry(content_type.pk).model_class,
+            Book)
+
+        self.moderation.unregister(Book)
+        self.assertIsNone(self.moderation.get_registry_entry(content_type.pk))
+
+    def test_moderator_of_moderated_object_uses_registry(self):
+        profile = UserProfile.objects.get(user__username='moderator')
+        moderated_object = ModeratedObject(content_object=profile)
+        moderated_object.save()
+        moderated_object = ModeratedObject.objects.get(pk=moderated_object.pk)
+        moderated_object.moderator
+
+        with self.assertNumQueries(0):
+            self.assertEqual(moderated_object.moderator,
+                             self.moderation.get_moderator(UserProfile))
+
     def test_get_of_new_object_should_raise_exception(self):
         """Tests if after register of model class with moderation, 
            when new object is created and getting of object 
@@ -386,7 +431,7 @@ class ModerationManagerTestCase(TestCase):
         # clean up
         self.moderation._remove_fields(moderator)
 
-    def test_get_or_create_moderated_object_exist(self):
+    def test_update_moderated_object_exist(self):
         self.moderation.register(UserProfile)
         profile = UserProfile.objects.get(user__username='moderator')
 
@@ -396,29 +441,35 @@ class ModerationManagerTestCase(TestCase):
 
         profile.description = "New description"
 
-        unchanged_obj = self.moderation._get_unchanged_object(profile)
-        obj = self.moderation._get_or_create_moderated_object(profile,
-                                                              unchanged_obj,
-                                                              moderator)
+        unchanged_obj, fetched_obj = \
+            self.moderation._get_unchanged_and_moderated_objects(profile)
+        obj = self.moderation._update_moderated_object(profile,
+                                                       unchanged_obj,
+                                                       fetched_obj,
+                                                       moderator)
 
         self.assertNotEqual(obj.pk, None)
+        self.assertEqual(obj.pk, fetched_obj.pk)
         self.assertEqual(obj.changed_object.description,
                          'Old description')
 
         self.moderation.unregister(UserProfile)
 
-    def test_get_or_create_moderated_object_does_not_exist(self):
+    def test_update_moderated_object_does_not_exist(self):
         profile = UserProfile.objects.get(user__username='moderator')
         profile.description = "New description"
 
         self.moderation.register(UserProfile)
         moderator = self.moderation.get_moderator(UserProfile)
 
-        unchanged_obj = self.moderation._get_unchanged_object(profile)
+        unchanged_obj, fetched_obj = \
+            self.moderation._get_unchanged_and_moderated_objects(profile)
+        self.assertEqual(fetched_obj, None)
 
-        object = self.moderation._get_or_create_moderated_object(profile,
-                                                                 unchanged_obj,
-                                                                 moderator)
+        object = self.moderation._update_moderated_object(profile,
+                                                          unchanged_obj,
+                                                          fetched_obj,
+                                                          moderator)
 
         self.assertEqual(object.pk, None)
         self.assertEqual(object.changed_object.description,
@@ -426,7 +477,7 @@ class ModerationManagerTestCase(TestCase):
 
         self.moderation.unregister(UserProfile)
 
-    def test_get_or_create_moderated_object_keep_history(self):
+    def test_update_moderated_object_keep_history(self):
         profile = UserProfile.objects.get(user__username='moderator')
         profile.description = "New description"
 
@@ -434,10 +485,11 @@ class ModerationManagerTestCase(TestCase):
         moderator = self.moderation.get_moderator(UserProfile)
         moderator.keep_history = True
 
-        unchanged_obj = self.moderation._get_unchanged_object(profile)
+        unchanged_obj, fetched_obj = \
+            self.moderation._get_unchanged_and_moderated_objects(profile)
 
-        moderated_object = self.moderation._get_or_create_moderated_object(
-            profile, unchanged_obj, moderator)
+        moderated_object = self.moderation._update_moderated_object(
+            profile, unchanged_obj, fetched_obj, moderator)
         self.assertEqual(moderated_object.pk, None)
         self.assertEqual(moderated_object.changed_object.description,
                          'Old description')
@@ -451,13 +503,62 @@ class ModerationManagerTestCase(TestCase):
         # If we call it again, we should get a new moderated_object, evidenced
         # by having no pk
 
-        moderated_object_2 = self.moderation._get_or_create_moderated_object(
-            profile, unchanged_obj, moderator)
+        unchanged_obj, fetched_obj = \
+            self.moderation._get_unchanged_and_moderated_objects(profile)
+        self.assertEqual(fetched_obj.pk, moderated_object.pk)
+
+        moderated_object_2 = self.moderation._update_moderated_object(
+            profile, unchanged_obj, fetched_obj, moderator)
 
         self.assertEqual(moderated_object_2.pk, None)
         self.assertEqual(moderated_object_2.changed_object.description,
                          'Old description')
 
+    def test_get_unchanged_and_moderated_objects(self):
+        self.moderation.register(UserProfile)
+        profile = UserProfile.objects.get(user__username='moderator')
+        moderated_object = ModeratedObject(content_object=profile)
+        moderated_object.save()
+
+        profile.description = "New description"
+
+        with self.assertNumQueries(1):
+            unchanged_obj, fetched_obj = \
+                self.moderation._get_unchanged_and_moderated_objects(profile)
+
+        self.assertEqual(unchanged_obj.description, 'Old description')
+        self.assertEqual(fetched_obj.pk, moderated_object.pk)
+        self.assertEqual(fetched_obj.changed_object.description,
+                         'Old description')
+
+        self.moderation.unregister(UserProfile)
+
+    def test_get_unchanged_and_moderated_objects_returns_latest(self):
+        self.moderation.register(UserProfile)
+        profile = UserProfile.objects.get(user__username='moderator')
+        ModeratedObject(content_object=profile).save()
+        latest = ModeratedObject(content_object=profile)
+        latest.save()
+
+        unchanged_obj, fetched_obj = \
+            self.moderation._get_unchanged_and_moderated_objects(profile)
+
+        self.assertEqual(fetched_obj.pk, latest.pk)
+
+        self.moderation.unregister(UserProfile)
+
+    def test_get_unchanged_and_moderated_objects_without_moderation(self):
+        self.moderation.register(UserProfile)
+        profile = UserProfile.objects.get(user__username='moderator')
+
+        unchanged_obj, fetched_obj = \
+            self.moderation._get_unchanged_and_moderated_objects(profile)
+
+        self.assertEqual(unchanged_obj.pk, profile.pk)
+        self.assertEqual(fetched_obj, None)
+
+        self.moderation.unregister(UserProfile)
+
     def test_get_unchanged_object(self):
         profile = UserProfile.objects.get(user__username='moderator')
         profile.description = "New description"
@@ -467,6 +568,131 @@ class ModerationManagerTestCase(TestCase):
         self.assertEqual(object.description,
                          'Old description')
 
+    def test_post_save_handler_reuses_save_context(self):
+        from mock import patch
+
+        self.moderation.register(UserProfile)
+        profile = UserProfile.objects.get(user__username='moderator')
+        moderated_object = ModeratedObject(content_object=profile)
+        moderated_object.save()
+        moderated_object.approve(by=self.user)
+
+        profile = UserProfile.objects.get(user__username='moderator')
+        with patch.object(ModeratedObject, 'has_object_been_changed') as diff:
+            with patch.object(ModeratedObject.objects.__class__,
+                              'get_for_instance') as get_for_instance:
+                profile.save()
+
+        self.assertFalse(get_for_instance.called)
+        self.assertFalse(diff.called)
+        self.assertFalse(hasattr(profile, '_moderation_context'))
+
+        self.moderation.unregister(UserProfile)
+
+    def test_post_save_handler_reuses_approved_moderated_object(self):
+        from mock import patch
+
+        self.moderation.register(UserProfile)
+        profile = UserProfile.objects.get(user__username='moderator')
+        moderated_object = ModeratedObject(content_object=profile)
+        moderated_object.save()
+        moderated_object.approve(by=self.user)
+
+        profile = UserProfile.objects.get(user__username='moderator')
+        profile.description = 'New description'
+        # Content types are cached for the lifetime of the process
+        ContentType.objects.get_for_model(UserProfile)
+        with patch.object(ModeratedObject, 'has_object_been_changed') as diff:
+            with patch.object(ModeratedObject.objects.__class__,
+                              'get_for_instance') as get_for_instance:
+                # Loading both objects, saving the profile, restoring it
+                # and saving the pending change
+                with self.assertNumQueries(4):
+                    profile.save()
+
+        self.assertFalse(get_for_instance.called)
+        self.assertFalse(diff.called)
+
+        moderated_object = ModeratedObject.objects.get(pk=moderated_object.pk)
+        self.assertEqual(moderated_object.status, MODERATION_STATUS_PENDING)
+        self.assertEqual(moderated_object.changed_object.description,
+                         'New description')
+        self.assertEqual(
+            UserProfile.unmoderated_objects.get(pk=profile.pk).description,
+            'Old description')
+
+        self.moderation.unregister(UserProfile)
+
+    def test_post_save_handler_uses_saved_moderated_object(self):
+        self.moderation.register(UserProfile)
+        profile = UserProfile.objects.get(user__username='moderator')
+        ModeratedObject(content_object=profile).save()
+
+        profile.description = 'New description'
+        profile.save()
+
+        moderated_object = ModeratedObject.objects.get_for_instance(profile)
+        self.assertEqual(moderated_object.status, MODERATION_STATUS_PENDING)
+        self.assertEqual(moderated_object.changed_object.description,
+                         'New description')
+        self.assertEqual(
+            UserProfile.unmoderated_objects.get(pk=profile.pk).description,
+            'Old description')
+        self.assertEqual(profile._moderated_object.pk, moderated_object.pk)
+
+        self.moderation.unregister(UserProfile)
+
+    def test_moderated_object_property_uses_one_query(self):
+        self.moderation.register(UserProfile)
+        profile = UserProfile.objects.get(user__username='moderator')
+        ModeratedObject(content_object=profile).save()
+        latest = ModeratedObject(content_object=profile)
+        latest.save()
+
+        profile = UserProfile.unmoderated_objects.get(pk=profile.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(profile.moderated_object.pk, latest.pk)
+
+    def test_moderated_object_property_without_moderated_object(self):
+        self.moderation.register(UserProfile)
+        profile = UserProfile.objects.get(user__username='moderator')
+
+        with self.assertRaises(ModeratedObject.DoesNotExist):
+            profile.moderated_object
+
+    def test_with_moderation_prefetches_moderated_objects(self):
+        self.moderation.register(UserProfile)
+        profiles = list(UserProfile.unmoderated_objects.all())
+        for profile in profiles[1:]:
+            moderated_object = ModeratedObject(content_object=profile)
+            moderated_object.save()
+            moderated_object.approve(by=self.user)
+
+        with self.assertNumQueries(2):
+            profiles = list(UserProfile.objects.with_moderation())
+            for profile in profiles[1:]:
+                self.assertEqual(profile.moderated_object.status,
+                                 MODERATION_STATUS_APPROVED)
+
+        # Fixture object without ModeratedObject
+        with self.assertRaises(ModeratedObject.DoesNotExist):
+            profiles[0].moderated_object
+
+    def test_with_moderation_prefetches_latest_moderated_object_only(self):
+        self.moderation.register(UserProfile)
+        profile = UserProfile.objects.get(user__username='moderator')
+        ModeratedObject(content_object=profile,
+                        state=MODERATION_READY_STATE).save()
+        latest = ModeratedObject(content_object=profile)
+        latest.save()
+
+        profiles = list(UserProfile.objects.filter(
+            pk=profile.pk).with_moderation())
+
+        self.assertEqual(profiles[0]._prefetched_moderated_objects, [latest])
+        with self.assertNumQueries(0):
+            self.assertEqual(profiles[0].moderated_object.pk, latest.pk)
+
 
 class LoadingFixturesTestCase(TestCase):
     fixtures = ['test_users.json']